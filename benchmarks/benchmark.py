@@ -0,0 +1,185 @@
+# encoding=utf8
+"""
+End-to-end benchmark of slipsomat against the local mock Alma server.
+
+Times the pull, defaults, push and test commands and reports per-letter latency
+percentiles. Requires a browser and its WebDriver, like slipsomat itself.
+
+    python benchmarks/benchmark.py --letters 150 --latency 0.05 --workers 4
+"""
+from __future__ import print_function
+import argparse
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from slipsomat import slipsomat  # noqa: E402
+from slipsomat.mockalma import MockAlma  # noqa: E402
+from slipsomat.stats import percentile  # noqa: E402
+from slipsomat.slipsomat import StatusFile, LocalStorage, TemplateConfigurationTable, TestPage  # noqa: E402
+from slipsomat.worker import Worker, WorkerPool  # noqa: E402
+
+CONFIG = u"""[login]
+auth_type=basic
+instance=mock
+institution=MOCK
+username=benchmark
+password=benchmark
+base_url={base_url}
+session_file=
+
+[selenium]
+browser={browser}
+headless={headless}
+default_timeout=20
+workers={workers}
+"""
+
+TEST_XML = u"""<notification_data>
+  <languages><string>en</string></languages>
+  <receivers><receiver><preferred_language>en</preferred_language></receiver></receivers>
+  <general_data><letter_type>Benchmark{n}</letter_type></general_data>
+</notification_data>
+"""
+
+
+class Timings(object):
+    """Collects the duration of each call to the functions it wraps."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.samples.setdefault(name, []).append(time.time() - t0)
+        return timed
+
+
+@contextmanager
+def quiet(enabled):
+    """Hide slipsomat's progress output."""
+    if not enabled:
+        yield
+        return
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark slipsomat against a local mock Alma server.')
+    parser.add_argument('--letters', type=int, default=50, help='number of letters in the table')
+    parser.add_argument('--size', type=int, default=5000, help='approximate size of each letter, in characters')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay added to each request, in seconds')
+    parser.add_argument('--workers', type=int, default=1, help='number of browsers')
+    parser.add_argument('--browser', default='firefox')
+    parser.add_argument('--no-headless', dest='headless', action='store_false')
+    parser.add_argument('--push', type=int, default=10, help='number of letters to modify and push')
+    parser.add_argument('--tests', type=int, default=3, help='number of test XML files')
+    parser.add_argument('--languages', default='en,nn', help='comma-separated languages to test')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help="show slipsomat's progress output")
+    args = parser.parse_args()
+
+    server = MockAlma(args.letters, args.size, args.latency).serve()
+    workspace = tempfile.mkdtemp(prefix='slipsomat-benchmark-')
+    json_path = os.path.abspath(args.json) if args.json else None
+    cwd = os.getcwd()
+    os.chdir(workspace)
+
+    with open('slipsomat.cfg', 'w') as fp:
+        fp.write(CONFIG.format(base_url=server.base_url, browser=args.browser,
+                               headless='true' if args.headless else 'false', workers=args.workers))
+
+    timings = Timings()
+    slipsomat.fetch_letter = timings.wrap('pull', slipsomat.fetch_letter)
+    slipsomat.fetch_default_letter = timings.wrap('defaults', slipsomat.fetch_default_letter)
+    TemplateConfigurationTable.put_contents = timings.wrap('push', TemplateConfigurationTable.put_contents)
+    TestPage.test = timings.wrap('test', TestPage.test)
+
+    totals = {}
+    worker = Worker('slipsomat.cfg')
+    pool = None
+    try:
+        t0 = time.time()
+        worker.connect()
+        pool = WorkerPool(worker)
+        status_file = StatusFile()
+        local_storage = LocalStorage(status_file)
+        table = TemplateConfigurationTable(worker)
+        testpage = TestPage(worker)
+        totals['startup'] = time.time() - t0
+
+        def run(name, fn, *fn_args):
+            print('Running {}...'.format(name))
+            t0 = time.time()
+            with quiet(not args.verbose), status_file.batch():
+                fn(*fn_args)
+            totals[name] = time.time() - t0
+
+        run('pull', slipsomat.pull, table, local_storage, status_file, pool)
+        run('defaults', slipsomat.pull_defaults, table, local_storage, status_file, pool)
+
+        files = table.filenames[:args.push]
+        for filename in files:
+            with open(filename, 'ab') as fp:
+                fp.write(b'\n<!-- modified by the benchmark -->')
+        run('push', slipsomat.push, table, local_storage, status_file, files)
+
+        os.mkdir('test-data')
+        test_files = []
+        for n in range(args.tests):
+            test_files.append(os.path.abspath(os.path.join('test-data', 'Benchmark{}.xml'.format(n))))
+            with open(test_files[-1], 'w') as fp:
+                fp.write(TEST_XML.format(n=n))
+        run('test', slipsomat.test, testpage, test_files, args.languages.split(','), pool)
+
+    finally:
+        if pool is not None:
+            pool.close()
+        elif worker.driver is not None:
+            worker.close()
+        os.chdir(cwd)
+        shutil.rmtree(workspace)
+        server.shutdown()
+
+    results = {}
+    print()
+    print('{:10} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'command', 'letters', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, total in totals.items():
+        samples = timings.samples.get(name, [])
+        results[name] = {'total': total, 'count': len(samples)}
+        row = '{:10} {:8d} {:9.2f}'.format(name, len(samples), total)
+        if len(samples) != 0:
+            samples = sorted(samples)
+            for p in (50, 90, 99):
+                results[name]['p%d' % p] = percentile(samples, p)
+            results[name]['max'] = max(samples)
+            row += ' {:9.0f} {:9.0f} {:9.0f} {:9.0f}'.format(*[
+                1000 * results[name][key] for key in ('p50', 'p90', 'p99', 'max')])
+        print(row)
+
+    if json_path is not None:
+        with open(json_path, 'w') as fp:
+            json.dump({'args': vars(args), 'results': results}, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
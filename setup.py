@@ -38,6 +38,10 @@ setup(name='slipsomat',
           'python-dateutil',
           'questionary',
       ],
+      extras_require={
+          'fastpath': ['requests'],
+          'render': ['lxml'],
+      },
       entry_points={
           'console_scripts': ['slipsomat=slipsomat.shell:main']
       },
@@ -0,0 +1,204 @@
+# encoding=utf8
+"""
+Dependencies between letters, the files they include and the test data using them.
+
+The xsl:include and xsl:import elements of each letter are parsed once, and kept in
+.slipsomat_deps.json until the contents of the letter change, so that we can quickly
+find out which letters and test-data files are affected by a change to a shared file
+like header.xsl.
+"""
+from __future__ import print_function
+import hashlib
+import json
+import os
+import re
+from xml.etree import ElementTree
+
+from .slipsomat import atomic_write
+from .stats import timed
+
+XSL_NAMESPACE = 'http://www.w3.org/1999/XSL/Transform'
+
+
+def normalize_path(path):
+    """Return a path relative to the current folder, with forward slashes like in status.json."""
+    return os.path.relpath(path).replace(os.sep, '/')
+
+
+def letter_candidates(doc, filename):
+    """
+    Return the names of the letters that a test XML file may be for, in order of preference.
+
+    The letter is given by the letter_type element of the XML, or else by the name of the
+    file, like "FulLoanReceiptLetter.xml" or "FulLoanReceiptLetter-renewal.xml".
+
+    Params:
+        doc: parsed XML file (ElementTree or lxml element), or None
+        filename: name of the XML file
+    """
+    names = []
+    letter_type = doc.findtext('.//general_data/letter_type') if doc is not None else None
+    if letter_type is not None and letter_type.strip() != '':
+        names.append(letter_type.strip())
+    basename = os.path.splitext(os.path.basename(filename))[0]
+    for name in (basename, re.split(r'[-_ .]', basename)[0]):
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def find_letter(names, letters_dir='xsl/letters'):
+    """Return the path of the first of the named letters that exists, or None."""
+    for name in names:
+        path = os.path.join(letters_dir, name + '.xsl')
+        if os.path.isfile(path):
+            return normalize_path(path)
+    return None
+
+
+def resolve_include(href, filename, sysconfig_dir):
+    """
+    Return the path of a file included from a letter.
+
+    Like in Alma, files not found next to the letter are looked up in the sysconfig folder.
+    """
+    path = os.path.normpath(os.path.join(os.path.dirname(filename), href))
+    if not os.path.isfile(path):
+        sysconfig_path = os.path.join(sysconfig_dir, os.path.basename(href))
+        if os.path.isfile(sysconfig_path):
+            path = sysconfig_path
+    return normalize_path(path)
+
+
+class DependencyGraph(object):
+    """The include graph of the letters, and the letters used by each test-data file."""
+
+    cache_file = '.slipsomat_deps.json'
+
+    def __init__(self, letters_dir='xsl/letters', test_dir='test-data'):
+        """
+        Construct a new DependencyGraph object.
+
+        Params:
+            letters_dir: Folder with the letters. Shared includes are looked up in its "sysconfig" subfolder.
+            test_dir: Folder with the test XML files
+        """
+        self.letters_dir = letters_dir
+        self.sysconfig_dir = os.path.join(letters_dir, 'sysconfig')
+        self.test_dir = test_dir
+        self.letters = {}
+        self.tests = {}
+        try:
+            with open(self.cache_file) as fp:
+                cache = json.load(fp)
+            if cache.get('version') == 1:
+                self.letters = cache['letters']
+                self.tests = cache['tests']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def find_files(folder, ext):
+        paths = []
+        for root, dirs, files in os.walk(folder):
+            paths += [normalize_path(os.path.join(root, name)) for name in files if name.endswith(ext)]
+        return sorted(paths)
+
+    @staticmethod
+    def read(filename):
+        """Return the contents and the checksum of a file."""
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        return data, hashlib.sha1(data).hexdigest()
+
+    def parse_letter(self, filename, data):
+        try:
+            root = ElementTree.fromstring(data)
+        except ElementTree.ParseError:
+            return []  # Reported by the check command
+        includes = []
+        for tag in ('include', 'import'):
+            for element in root.iter('{%s}%s' % (XSL_NAMESPACE, tag)):
+                href = element.get('href', '')
+                if href != '' and '://' not in href:
+                    includes.append(resolve_include(href, filename, self.sysconfig_dir))
+        return includes
+
+    @staticmethod
+    def parse_test(filename, data):
+        try:
+            doc = ElementTree.fromstring(data)
+        except ElementTree.ParseError:
+            doc = None
+        return letter_candidates(doc, filename)
+
+    @timed('deps.update')
+    def update(self):
+        """Parse the files that are new or have changed since the last update, and save the graph."""
+        changed = False
+        for entries, folder, ext, parse, key in (
+                (self.letters, self.letters_dir, '.xsl', self.parse_letter, 'includes'),
+                (self.tests, self.test_dir, '.xml', self.parse_test, 'letters')):
+            paths = self.find_files(folder, ext)
+            for path in set(entries) - set(paths):
+                del entries[path]
+                changed = True
+            for path in paths:
+                data, sha1 = self.read(path)
+                if path in entries and entries[path]['sha1'] == sha1:
+                    continue
+                entries[path] = {'sha1': sha1, key: parse(path, data)}
+                changed = True
+
+        if changed:
+            data = json.dumps({'version': 1, 'letters': self.letters, 'tests': self.tests}, sort_keys=True)
+            atomic_write(self.cache_file, data.encode('utf-8'))
+        return self
+
+    def dependencies(self, filename):
+        """Return the set of files included by a letter, directly or indirectly."""
+        found = set()
+        stack = [normalize_path(filename)]
+        while len(stack) != 0:
+            for path in self.letters.get(stack.pop(), {}).get('includes', []):
+                if path not in found:
+                    found.add(path)
+                    stack.append(path)
+        return found
+
+    def dependents(self, filenames):
+        """Return the set of letters that are or include any of the files, directly or indirectly."""
+        included_by = {}
+        for path, entry in self.letters.items():
+            for include in entry['includes']:
+                included_by.setdefault(include, set()).add(path)
+
+        found = set()
+        stack = [normalize_path(filename) for filename in filenames]
+        while len(stack) != 0:
+            path = stack.pop()
+            if path in found:
+                continue
+            found.add(path)
+            stack += included_by.get(path, [])
+        return set(path for path in found if path in self.letters)
+
+    def letter_for_test(self, filename):
+        """Return the path of the letter used by a test XML file, or None if there is no such letter."""
+        filename = normalize_path(filename)
+        if filename in self.tests:
+            names = self.tests[filename]['letters']
+        else:
+            names = letter_candidates(None, filename)
+        return find_letter(names, self.letters_dir)
+
+    def affected(self, filenames):
+        """
+        Return the letters and the test-data files affected by changes to some files.
+
+        Returns a tuple of two sorted lists: the letters that are or include any of the files,
+        and the test XML files using these letters.
+        """
+        letters = self.dependents(filenames)
+        tests = [path for path in self.tests if self.letter_for_test(path) in letters]
+        return sorted(letters), sorted(tests)
@@ -0,0 +1,138 @@
+# encoding=utf8
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from html.parser import HTMLParser  # Python 3
+except ImportError:
+    from HTMLParser import HTMLParser  # Python 2
+
+from .stats import timed
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+
+class LetterPageParser(HTMLParser):
+    """Extract the filename and the letter contents from a "Configuration File" page."""
+
+    fields = ('pageBeanconfigFilefilename', 'pageBeanfileContent')
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.values = {}
+        self.current = None
+
+    def handle_starttag(self, tag, attrs):
+        element_id = dict(attrs).get('id')
+        if self.current is None and element_id in self.fields:
+            self.current = (element_id, tag)
+            self.values[element_id] = []
+
+    def handle_endtag(self, tag):
+        if self.current is not None and tag == self.current[1]:
+            self.current = None
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.values[self.current[0]].append(data)
+
+    def get(self, element_id):
+        if element_id not in self.values:
+            return None
+        return ''.join(self.values[element_id])
+
+
+class HttpFetcher(object):
+    """
+    Fetch letter pages over plain HTTP, using the session of a logged-in Worker.
+
+    This is a lot faster than clicking through the letters in the browser, but it
+    depends on the letter links in the table pointing to real URLs. When a page
+    can't be fetched or doesn't look like we expect, None is returned so that the
+    caller can fall back to the browser.
+    """
+
+    def __init__(self, worker, concurrency=None):
+        """
+        Construct a new HttpFetcher object.
+
+        Params:
+            worker: Connected Worker object to borrow the session from
+            concurrency: Number of simultaneous requests. Defaults to the "concurrency"
+                option in the [http] section of slipsomat.cfg
+        """
+        if requests is None:
+            raise RuntimeError('The HTTP fast path requires the "requests" package. '
+                               'Please run "pip install requests" to install it.')
+        if concurrency is None:
+            concurrency = int(worker.config.get('http', 'concurrency'))
+        self.worker = worker
+        self.concurrency = max(1, concurrency)
+        self.session = None
+
+    def sync_session(self):
+        """Copy the cookies and user agent from the browser into a pooled requests session."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        driver = self.worker.driver
+        session.headers['User-Agent'] = driver.execute_script('return navigator.userAgent;')
+        for cookie in driver.get_cookies():
+            session.cookies.set(cookie['name'], cookie['value'],
+                                domain=cookie.get('domain'), path=cookie.get('path', '/'))
+
+        self.session = session
+
+    @timed('http.fetch')
+    def fetch(self, filename, url):
+        """Fetch a letter page and return the letter contents, or None if that failed."""
+        policy = self.worker.retry_policy
+        policy.wait_if_open()
+        try:
+            response = self.session.get(url, timeout=self.worker.default_timeout)
+        except requests.RequestException:
+            policy.failure()
+            return None
+        if response.status_code == 429 or response.status_code >= 500:
+            # Alma is struggling, let the circuit breaker know
+            policy.failure()
+            return None
+        policy.success()
+        if response.status_code != 200:
+            return None
+
+        parser = LetterPageParser()
+        parser.feed(response.text)
+        parser.close()
+
+        # Make sure we didn't get the login page or some other letter
+        page_filename = (parser.get('pageBeanconfigFilefilename') or '').strip().replace('../', '')
+        if page_filename != filename:
+            return None
+
+        return parser.get('pageBeanfileContent')
+
+    def fetch_many(self, letters):
+        """
+        Fetch several letters concurrently.
+
+        Params:
+            letters: list of (filename, url) tuples
+
+        Yields (filename, text) tuples in order of completion, where text is None
+        for letters that could not be fetched.
+        """
+        if len(letters) == 0:
+            return
+
+        self.sync_session()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.fetch, filename, url): filename for filename, url in letters}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
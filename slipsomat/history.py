@@ -0,0 +1,253 @@
+# encoding=utf8
+"""
+A local history of every version of the default letters seen by the defaults command.
+
+The contents of each version are stored once, compressed, in a file named by its
+SHA-1 checksum, and a timeline of the versions of each letter is kept in an index:
+
+    .slipsomat_defaults_history/objects/ab/cdef0123...
+    .slipsomat_defaults_history/defaults.json
+
+Since Alma doesn't tell when a default letter was changed, the time of a version is the
+time it was first seen.
+"""
+from __future__ import print_function
+import difflib
+import json
+import os
+import threading
+import zlib
+from datetime import datetime
+
+from .slipsomat import atomic_write
+
+
+def merge3(base, ours, theirs):
+    """
+    Merge the changes from base to ours and from base to theirs, line by line.
+
+    Returns a tuple of the merged lines and the number of conflicts. Conflicting
+    changes are included with conflict markers like the ones used by git.
+    """
+    def matches(a, b):
+        matched = {}
+        for i, j, n in difflib.SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks():
+            for k in range(n):
+                matched[i + k] = j + k
+        return matched
+
+    in_ours = matches(base, ours)
+    in_theirs = matches(base, theirs)
+    merged = []
+    conflicts = 0
+    i = o = t = 0
+    while True:
+        # Find the next line of the base that is unchanged in both versions
+        i2 = next((k for k in range(i, len(base)) if k in in_ours and k in in_theirs), len(base))
+        o2 = in_ours.get(i2, len(ours))
+        t2 = in_theirs.get(i2, len(theirs))
+
+        base_chunk, ours_chunk, theirs_chunk = base[i:i2], ours[o:o2], theirs[t:t2]
+        if ours_chunk == theirs_chunk or theirs_chunk == base_chunk:
+            merged += ours_chunk
+        elif ours_chunk == base_chunk:
+            merged += theirs_chunk
+        else:
+            conflicts += 1
+            merged += ['<<<<<<< ours'] + ours_chunk + ['||||||| base'] + base_chunk + ['======='] \
+                + theirs_chunk + ['>>>>>>> theirs']
+
+        if i2 == len(base):
+            return merged, conflicts
+        merged.append(base[i2])
+        i, o, t = i2 + 1, o2 + 1, t2 + 1
+
+
+class HistoryStore(object):
+    """Content-addressed store of the versions of the default letters."""
+
+    def __init__(self, root='.slipsomat_defaults_history'):
+        """
+        Construct a new HistoryStore object.
+
+        Params:
+            root: Folder to keep the objects and the index in
+        """
+        self.root = root
+        self.index_file = os.path.join(root, 'defaults.json')
+        self.lock = threading.Lock()
+        self.unsaved = False
+        self.letters = {}
+        try:
+            with open(self.index_file) as fp:
+                index = json.load(fp)
+            if index.get('version') == 1:
+                self.letters = index['letters']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def object_path(self, sha1):
+        return os.path.join(self.root, 'objects', sha1[:2], sha1[2:])
+
+    def get(self, sha1):
+        """Return the text of a version."""
+        with open(self.object_path(sha1), 'rb') as fp:
+            return zlib.decompress(fp.read()).decode('utf-8')
+
+    def add(self, filename, content, seen=None):
+        """
+        Record a version of a default letter, unless it's the latest version already.
+
+        Params:
+            filename: Name of the letter
+            content: LetterContent object
+            seen: datetime the version was seen. Defaults to now.
+
+        Returns True if this is a new version of the letter.
+        """
+        path = self.object_path(content.sha1)
+        if not os.path.isfile(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            atomic_write(path, zlib.compress(content.text.encode('utf-8'), 9))
+
+        with self.lock:
+            timeline = self.letters.setdefault(filename, [])
+            if len(timeline) != 0 and timeline[-1][1] == content.sha1:
+                return False
+            timeline.append([(seen or datetime.now()).strftime('%Y-%m-%dT%H:%M:%S'), content.sha1])
+            self.unsaved = True
+        return True
+
+    def save(self):
+        if not self.unsaved:
+            return
+        with self.lock:
+            data = json.dumps({'version': 1, 'letters': self.letters}, sort_keys=True, indent=1)
+            self.unsaved = False
+        atomic_write(self.index_file, data.encode('utf-8'))
+
+    def log(self, filename):
+        """Return the (time, sha1) tuples of the versions of a letter, oldest first."""
+        return [tuple(entry) for entry in self.letters.get(filename, [])]
+
+    def version_at(self, filename, when):
+        """Return the checksum of the version of a letter current at a datetime, or None."""
+        sha1 = None
+        for seen, version in self.log(filename):
+            if seen > when.strftime('%Y-%m-%dT%H:%M:%S'):
+                break
+            sha1 = version
+        return sha1
+
+    def changed_since(self, when):
+        """
+        Return the letters that have changed since a datetime.
+
+        Returns a sorted list of (filename, time, old sha1, new sha1) tuples, where old sha1
+        is the version current at the datetime, and time is when the latest version was seen.
+        For letters first seen after the datetime, the first version seen is used as the
+        old version, so the first version seen of a letter does not count as a change.
+        """
+        changes = []
+        for filename, timeline in self.letters.items():
+            old_sha1 = self.version_at(filename, when) or timeline[0][1]
+            if old_sha1 != timeline[-1][1]:
+                changes.append((filename, timeline[-1][0], old_sha1, timeline[-1][1]))
+        return sorted(changes)
+
+    def merge(self, filename, ours, base_sha1, theirs_sha1=None):
+        """
+        Merge the changes made to a default letter into our customized version of it.
+
+        Params:
+            filename: Name of the letter
+            ours: Text of our customized version
+            base_sha1: Checksum of the default version our version was based on
+            theirs_sha1: Checksum of the new default version. Defaults to the latest version.
+
+        Returns a tuple of the merged text and the number of conflicts.
+        """
+        if theirs_sha1 is None:
+            theirs_sha1 = self.log(filename)[-1][1]
+        merged, conflicts = merge3(self.get(base_sha1).split('\n'), ours.split('\n'),
+                                   self.get(theirs_sha1).split('\n'))
+        return '\n'.join(merged), conflicts
+
+
+def changed_defaults(history, since):
+    """
+    List the default letters that have changed since a datetime.
+
+    Params:
+        history: HistoryStore object
+        since: datetime object
+
+    Returns a list of (filename, time, old sha1, new sha1) tuples.
+    """
+    changes = history.changed_since(since)
+    for filename, seen, old_sha1, new_sha1 in changes:
+        print(' - {}: {} -> {} ({})'.format(filename.replace('xsl/letters/', ''), old_sha1[0:7], new_sha1[0:7],
+                                            seen.replace('T', ' ')))
+    print('{} default letters changed since {}'.format(len(changes), since.strftime('%Y-%m-%d %H:%M')))
+    return changes
+
+
+def print_log(history, filename):
+    """
+    List the versions seen of a default letter, oldest first.
+
+    Params:
+        history: HistoryStore object
+        filename: Name of the letter, like "xsl/letters/FulLoanReceiptLetter.xsl"
+
+    Returns a list of (time, sha1) tuples.
+    """
+    timeline = history.log(filename)
+    for seen, sha1 in timeline:
+        print(' - {} {}'.format(sha1[0:7], seen.replace('T', ' ')))
+    if len(timeline) == 0:
+        print('No versions of the default {} have been seen'.format(filename))
+    return timeline
+
+
+def merge_default(history, local_storage, filename, base_sha1=None):
+    """
+    Merge the latest changes to a default letter into our customized version of it.
+
+    The merged letter is written to xsl/letters, where it can be reviewed and pushed.
+
+    Params:
+        history: HistoryStore object
+        local_storage: LocalStorage object
+        filename: Name of the letter, like "xsl/letters/FulLoanReceiptLetter.xsl"
+        base_sha1: Checksum of the default version our version is based on.
+            Defaults to the version before the latest one.
+
+    Returns the number of conflicts, or None if nothing could be merged.
+    """
+    timeline = history.log(filename)
+    if base_sha1 is None:
+        if len(timeline) < 2:
+            print('Error: No changes to the default version of {} have been seen'.format(filename))
+            return None
+        base_sha1 = timeline[-2][1]
+    matches = [sha1 for seen, sha1 in timeline if sha1.startswith(base_sha1)]
+    if len(matches) == 0:
+        print('Error: No version {} of the default {} found'.format(base_sha1, filename))
+        return None
+
+    ours = local_storage.get_content(filename)
+    if ours.text.strip() == '':
+        print('Error: There is no local version of {} to merge into. Use "pull" to get it.'.format(filename))
+        return None
+    merged, conflicts = history.merge(filename, ours.text, matches[-1])
+    with open(filename, 'wb') as fp:
+        fp.write(merged.encode('utf-8'))
+
+    if conflicts == 0:
+        print('Merged {} into {} without conflicts'.format(timeline[-1][1][0:7], filename))
+    else:
+        print('Merged {} into {} with {} conflicts, please resolve them before pushing'.format(
+            timeline[-1][1][0:7], filename, conflicts))
+    return conflicts
@@ -0,0 +1,389 @@
+# encoding=utf8
+"""
+A local stand-in for the parts of Alma that slipsomat talks to.
+
+The server implements just enough of the login page, the "Customize Letters" table,
+the letter edit form, the network zone confirmation dialog and the "Notification
+Template" page for slipsomat to work against it, so that it can be benchmarked
+without a live Alma instance. Point slipsomat to it with the `base_url` option
+in the [login] section of slipsomat.cfg, and use `auth_type=basic`.
+
+Run it with:
+
+    python -m slipsomat.mockalma --port 8000 --letters 150 --size 5000 --latency 0.05
+"""
+from __future__ import print_function
+import argparse
+import email.parser
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape, quoteattr
+
+
+LANGUAGES = [('en', 'English'), ('no', 'Norwegian Bokmål'), ('nn', 'Norwegian Nynorsk'), ('de', 'German')]
+
+PAGE = u"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script>
+function show(id) {{ document.getElementById(id).style.display = 'block'; }}
+function toggle(id) {{
+    var el = document.getElementById(id);
+    el.style.display = el.style.display === 'block' ? 'none' : 'block';
+}}
+</script>
+<style>
+a {{ display: block; }}
+ul {{ list-style: none; }}
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+def generate_letter(name, size):
+    """Generate a valid XSL letter of roughly `size` characters."""
+    padding = []
+    length = 0
+    while length < size:
+        line = '  <!-- {} -->'.format(uuid.uuid4().hex * 2)
+        padding.append(line)
+        length += len(line) + 1
+    return u'\n'.join([
+        '<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">',
+        '  <xsl:template match="/">',
+        '    <html><body><h1>{}</h1><xsl:value-of select="//preferred_language"/></body></html>'.format(name),
+        '  </xsl:template>',
+    ] + padding + ['</xsl:stylesheet>'])
+
+
+class MockAlma(object):
+    """The state of the mock Alma instance."""
+
+    def __init__(self, letters=150, size=5000, latency=0.0, seed=0):
+        """
+        Construct a new MockAlma object.
+
+        Params:
+            letters: Number of letters in the table
+            size: Approximate size of each letter, in characters
+            latency: Delay added to each request, in seconds
+            seed: Seed for the random choices of which letters are customized
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.rows = []
+
+        rnd = random.Random(seed)
+        for n in range(letters):
+            if n % 10 == 9:
+                name = 'sms/SmsMockLetter{:03d}'.format(n)
+            else:
+                name = 'MockLetter{:03d}'.format(n)
+            default = generate_letter(name, size)
+            customized = rnd.random() < 0.3
+            self.rows.append({
+                'filename': 'xsl/letters/{}.xsl'.format(name),
+                'default': default,
+                'text': default.replace('<h1>', '<h1 class="custom">') if customized else default,
+                'updated': '01/01/2019',
+                'updated_by': 'someone' if customized else rnd.choice(['-', 'Network']),
+            })
+
+    def is_customized(self, row):
+        return row['updated_by'] not in ('-', 'Network')
+
+    def save_letter(self, index, text, username):
+        with self.lock:
+            row = self.rows[index]
+            row['text'] = text
+            row['updated'] = datetime.now().strftime('%d/%m/%Y')
+            row['updated_by'] = username
+
+    def serve(self, host='127.0.0.1', port=0):
+        """Start the server in a background thread and return it. Use port 0 for any free port."""
+        server = MockAlmaServer((host, port), MockAlmaHandler)
+        server.alma = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class MockAlmaServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+
+class MockAlmaHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def alma(self):
+        return self.server.alma
+
+    def session(self):
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == 'mocksession' and value in self.alma.sessions:
+                return self.alma.sessions[value]
+
+    def send_html(self, title, body, status=200, headers=None):
+        content = PAGE.format(title=escape(title), body=body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def redirect(self, location, headers=None):
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        time.sleep(self.alma.latency)
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/mng/login':
+            return self.login(method)
+
+        session = self.session()
+        if session is None:
+            if url.path.startswith('/mng/'):
+                return self.redirect('/mng/login')
+            return self.send_html('Not found', '<p>Not found</p>', 404)
+
+        routes = {
+            '/mng/action/home.do': self.home,
+            '/mng/action/letters.do': self.letters,
+            '/mng/action/letter.do': self.letter,
+            '/mng/action/notification.do': self.notification,
+            '/mng/action/notification_output.do': self.notification_output,
+        }
+        if url.path not in routes:
+            return self.send_html('Not found', '<p>Not found</p>', 404)
+        routes[url.path](method, query, session)
+
+    def login(self, method):
+        if method == 'POST':
+            form = {key: values[0] for key, values in parse_qs(self.read_body().decode('utf-8')).items()}
+            session_id = uuid.uuid4().hex
+            self.alma.sessions[session_id] = {'username': form.get('username', ''), 'upload': None}
+            return self.redirect('/mng/action/home.do', {
+                'Set-Cookie': 'mocksession={}; Path=/'.format(session_id),
+            })
+
+        self.send_html('Login', u"""
+            <form method="post" action="/mng/login">
+            <input type="text" id="username" name="username">
+            <input type="password" id="password" name="password">
+            <input type="submit" value="Login">
+            </form>
+        """)
+
+    def home(self, method, query, session):
+        self.send_html('Alma', u"""
+            <div class="logoAlma">Alma</div>
+            <button id="ALMA_MENU_TOP_NAV_configuration" onclick="show('confmenu')">Configuration</button>
+            <div id="confmenu" style="display: none">
+                <a href="#CONF_MENU6" onclick="show('CONF_MENU6'); return false;">General</a>
+                <div id="CONF_MENU6" style="display: none">
+                    <a href="/mng/action/letters.do">Customize Letters</a>
+                    <a href="/mng/action/notification.do">Notification Template</a>
+                </div>
+            </div>
+        """)
+
+    def letters(self, method, query, session):
+        rows = []
+        with self.alma.lock:
+            for n, row in enumerate(self.alma.rows):
+                url = '/mng/action/letter.do?row={}&amp;mode='.format(n)
+                if self.alma.is_customized(row):
+                    actions = (
+                        u'<li id="ROW_ACTION_fileList_{n}_c.ui.table.btn.edit"><a href="{url}edit">Edit</a></li>'
+                        u'<li id="ROW_ACTION_fileList_{n}_c.ui.table.btn.view_default">'
+                        u'<a href="{url}default">View Default</a></li>'
+                    ).format(n=n, url=url)
+                else:
+                    actions = u'<li id="ROW_ACTION_fileList_{n}"><a href="{url}customize">Customize</a></li>'.format(
+                        n=n, url=url)
+                rows.append(u"""
+                    <tr>
+                    <td>{n1}</td>
+                    <td id="SELENIUM_ID_fileList_ROW_{n}_COL_cfgFilefilename"><a href="{url}view">../{filename}</a></td>
+                    <td><span>{updated}</span></td>
+                    <td><span id="SPAN_SELENIUM_ID_fileList_ROW_{n}_COL_cfgFileupdatedBy">{updated_by}</span></td>
+                    <td>
+                        <button id="input_fileList_{n}" onclick="toggle('menu_{n}')">...</button>
+                        <ul id="menu_{n}" style="display: none">{actions}</ul>
+                    </td>
+                    </tr>
+                """.format(n=n, n1=n + 1, url=url, filename=escape(row['filename']), updated=row['updated'],
+                           updated_by=escape(row['updated_by']), actions=actions))
+
+        self.send_html('Customize Letters', u"""
+            <div class="pageTitle">Customize Letters</div>
+            <div class="typeD">
+            <table id="TABLE_DATA_fileList">
+            <tr>
+            <th id="SELENIUM_ID_fileList_HEADER_rowNumber">#</th>
+            <th id="SELENIUM_ID_fileList_HEADER_cfgFilefilename">Filename</th>
+            <th id="SELENIUM_ID_fileList_HEADER_updateDate">Update Date</th>
+            <th id="SELENIUM_ID_fileList_HEADER_cfgFileupdatedBy">Updated By</th>
+            <th></th>
+            </tr>
+            {rows}
+            </table>
+            </div>
+        """.format(rows=''.join(rows)))
+
+    def letter(self, method, query, session):
+        index = int(query.get('row', -1))
+        mode = query.get('mode', 'view')
+        if not 0 <= index < len(self.alma.rows):
+            return self.send_html('Not found', '<p>Not found</p>', 404)
+        row = self.alma.rows[index]
+
+        if method == 'POST':
+            form = {key: values[0] for key, values in
+                    parse_qs(self.read_body().decode('utf-8'), keep_blank_values=True).items()}
+            self.alma.save_letter(index, form.get('content', ''), session['username'])
+            return self.redirect('/mng/action/letters.do')
+
+        if mode == 'customize' and row['updated_by'] == 'Network' and 'confirmed' not in query:
+            return self.send_html('Confirmation', u"""
+                <p>This row is managed in the Network. If customized, no future updates will be
+                retrieved from the Network for this row. Are you sure you want to proceed?</p>
+                <a id="PAGE_BUTTONS_cbuttonconfirmationconfirm"
+                   href="/mng/action/letter.do?row={}&amp;mode=customize&amp;confirmed=1">Confirm</a>
+            """.format(index))
+
+        if mode == 'default' or (mode == 'customize' and not self.alma.is_customized(row)):
+            text = row['default']
+        else:
+            text = row['text']
+        action = '/mng/action/letter.do?row={}&amp;mode=save'.format(index)
+        if mode == 'edit':
+            buttons = (u'<button type="submit" id="PAGE_BUTTONS_cbuttonsave">Save</button>'
+                       u'<a id="PAGE_BUTTONS_cbuttonnavigationcancel" href="/mng/action/letters.do">Cancel</a>')
+        elif mode == 'customize':
+            buttons = (u'<button type="submit" id="PAGE_BUTTONS_cbuttoncustomize">Customize</button>'
+                       u'<a id="PAGE_BUTTONS_cbuttonnavigationcancel" href="/mng/action/letters.do">Cancel</a>')
+        else:
+            buttons = u'<a id="PAGE_BUTTONS_cbuttonback" href="/mng/action/letters.do">Back</a>'
+
+        self.send_html('Configuration File', u"""
+            <div class="pageTitle">Configuration File</div>
+            <form method="post" action="{action}">
+            <span id="pageBeanconfigFilefilename">../{filename}</span>
+            <textarea id="pageBeanfileContent" name="content" rows="30" cols="100">{text}</textarea>
+            {buttons}
+            </form>
+        """.format(action=action, filename=escape(row['filename']), text=escape(text), buttons=buttons))
+
+    def notification(self, method, query, session):
+        if method == 'POST':
+            header = b'Content-Type: ' + self.headers.get('Content-Type', '').encode('ascii') + b'\r\n\r\n'
+            message = email.parser.BytesParser().parsebytes(header + self.read_body())
+            form = {}
+            for part in message.get_payload():
+                form[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True)
+            session['upload'] = (form.get('file', b'').decode('utf-8'), form.get('lang', b'en').decode('utf-8'))
+
+        options = u''.join(u'<option value="{}">{}</option>'.format(code, name) for code, name in LANGUAGES)
+        items = u''.join(
+            u'<li title={title}><a href="#" onclick="pick(\'{code}\'); return false;">{name}</a></li>'.format(
+                title=quoteattr(name), code=escape(code), name=escape(name))
+            for code, name in LANGUAGES)
+        result = u''
+        if session['upload'] is not None:
+            result = u"""
+                <div class="infoErrorMessages">The file was uploaded</div>
+                <button id="PAGE_BUTTONS_admconfigure_notification_templaterun_xsl"
+                        onclick="window.open('/mng/action/notification_output.do')">Run XSL</button>
+            """
+
+        self.send_html('Notification Template', u"""
+            <div class="pageTitle">Notification Template</div>
+            <script>
+            function pick(code) {{
+                document.getElementById('pageBeanuserPreferredLanguage_hiddenSelect').value = code;
+                document.getElementById('pageBeanuserPreferredLanguage').innerText = code;
+                document.getElementById('pageBeanuserPreferredLanguage_hiddenSelect_list').style.display = 'none';
+            }}
+            </script>
+            <form method="post" enctype="multipart/form-data" action="/mng/action/notification.do">
+            <div id="pageBeanuserPreferredLanguage"
+                 onclick="show('pageBeanuserPreferredLanguage_hiddenSelect_list')">en</div>
+            <select id="pageBeanuserPreferredLanguage_hiddenSelect" name="lang" style="display: none">
+            {options}
+            </select>
+            <ul id="pageBeanuserPreferredLanguage_hiddenSelect_list" style="display: none">{items}</ul>
+            <input type="file" id="pageBeannewFormFile" name="file">
+            <button type="submit" id="cbuttonupload">Upload</button>
+            </form>
+            {result}
+        """.format(options=options, items=items, result=result))
+
+    def notification_output(self, method, query, session):
+        xml, lang = session['upload'] or ('', 'en')
+        self.send_html('Output', u"""
+            <h1>Notification output ({lang})</h1>
+            <pre>{xml}</pre>
+        """.format(lang=escape(lang), xml=escape(xml)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for Alma.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--letters', type=int, default=150, help='number of letters in the table')
+    parser.add_argument('--size', type=int, default=5000, help='approximate size of each letter, in characters')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay added to each request, in seconds')
+    args = parser.parse_args()
+
+    server = MockAlma(args.letters, args.size, args.latency).serve(args.host, args.port)
+    print('Serving mock Alma at {}'.format(server.base_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# encoding=utf8
+"""
+Render letter previews locally with lxml, without going through Alma.
+
+The letters in xsl/letters are applied to the XML files in test-data, with the
+includes shared by all the letters (header.xsl, footer.xsl, style.xsl, etc.)
+resolved from xsl/letters/sysconfig the way Alma does it.
+"""
+from __future__ import print_function
+import os
+import threading
+
+from .deps import letter_candidates, find_letter
+from .slipsomat import set_preferred_language
+from .stats import timed
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+if etree is not None:
+    class SysconfigResolver(etree.Resolver):
+        """
+        Resolve stylesheet includes, looking in the sysconfig folder for files not found next to the letter.
+
+        All the files resolved are recorded, so that changes to them can be detected.
+        """
+
+        def __init__(self, sysconfig_dir):
+            super(SysconfigResolver, self).__init__()
+            self.sysconfig_dir = sysconfig_dir
+            self.files = []
+
+        def resolve(self, url, pubid, context):
+            path = url[len('file://'):] if url.startswith('file://') else url
+            if not os.path.isfile(path):
+                path = os.path.join(self.sysconfig_dir, os.path.basename(path))
+                if not os.path.isfile(path):
+                    return None
+            self.files.append(path)
+            return self.resolve_filename(path, context)
+
+
+class LocalRenderer(object):
+    """
+    Apply letter stylesheets to test XML files.
+
+    Compiled stylesheets are cached, and only compiled again when the letter or one of
+    the files it includes has changed.
+    """
+
+    def __init__(self, letters_dir='xsl/letters'):
+        """
+        Construct a new LocalRenderer object.
+
+        Params:
+            letters_dir: Folder with the letters. Shared includes are looked up in its "sysconfig" subfolder.
+        """
+        if etree is None:
+            raise RuntimeError('Local rendering requires the "lxml" package. '
+                               'Please run "pip install lxml" to install it.')
+        self.letters_dir = letters_dir
+        self.sysconfig_dir = os.path.join(letters_dir, 'sysconfig')
+        self.stylesheets = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def signature(files):
+        signature = []
+        for filename in files:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                return None
+            signature.append((filename, stat.st_size, stat.st_mtime_ns))
+        return signature
+
+    def letter_for(self, doc, filename):
+        """
+        Return the path of the letter to use for a test XML file.
+
+        The letter is found from the letter_type element of the XML, or else from the name of
+        the file, like "FulLoanReceiptLetter.xml" or "FulLoanReceiptLetter-renewal.xml".
+        """
+        names = letter_candidates(doc, filename)
+        path = find_letter(names, self.letters_dir)
+        if path is None:
+            raise RuntimeError('No letter found for {}, tried {}'.format(os.path.basename(filename), ', '.join(names)))
+        return path
+
+    @timed('render.compile')
+    def compile(self, path):
+        resolver = SysconfigResolver(self.sysconfig_dir)
+        parser = etree.XMLParser()
+        parser.resolvers.add(resolver)
+        try:
+            xslt = etree.XSLT(etree.parse(path, parser))
+        except (etree.XMLSyntaxError, etree.XSLTParseError) as e:
+            raise RuntimeError('{}: {}'.format(path, e))
+        return xslt, [path] + resolver.files
+
+    def stylesheet(self, path):
+        """Return the compiled stylesheet for a letter."""
+        with self.lock:
+            cached = self.stylesheets.get(path)
+        if cached is not None and self.signature(cached[1]) == cached[2]:
+            return cached[0]
+
+        xslt, files = self.compile(path)
+        with self.lock:
+            self.stylesheets[path] = (xslt, files, self.signature(files))
+        return xslt
+
+    @timed('render.render')
+    def render(self, filename, lang):
+        """
+        Render a test XML file in a language, and save the output next to it.
+
+        Returns the path of the HTML output. Raises RuntimeError if the letter can't be rendered.
+        """
+        if not os.path.isfile(filename):
+            raise RuntimeError('File not found: %s' % filename)
+
+        with open(filename, 'rb') as fp:
+            data = set_preferred_language(fp.read(), lang)
+        try:
+            doc = etree.fromstring(data)
+        except etree.XMLSyntaxError as e:
+            raise RuntimeError('{}: {}'.format(os.path.basename(filename), e))
+
+        xslt = self.stylesheet(self.letter_for(doc, filename))
+        try:
+            output = xslt(doc)
+        except etree.XSLTApplyError as e:
+            raise RuntimeError('{}: {}'.format(os.path.basename(filename), e))
+
+        html_path = '%s_%s_local.html' % (os.path.splitext(filename)[0], lang)
+        with open(html_path, 'wb') as fp:
+            fp.write(bytes(output))
+        return html_path
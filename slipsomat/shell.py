@@ -1,5 +1,7 @@
 # encoding=utf8
 from __future__ import print_function
+import argparse
+import json
 import os
 import sys
 import shlex
@@ -8,13 +10,25 @@ from glob import glob
 from cmd import Cmd
 import traceback
 import questionary
+from dateutil import parser as date_parser
 
 from . import __version__
-from .worker import Worker
-from .slipsomat import StatusFile, LocalStorage, TemplateConfigurationTable, TestPage
-from .slipsomat import pull, pull_defaults, push, test
+from .worker import Worker, WorkerPool
+from .fastpath import HttpFetcher
+from .deps import DependencyGraph
+from .history import HistoryStore, changed_defaults, merge_default, print_log
+from .render import LocalRenderer
+from .stats import stats
+from .slipsomat import StatusFile, LocalStorage, TemplateConfigurationTable, TestPage, RenderCache, RemoteIndex
+from .slipsomat import pull, pull_defaults, push, test, check, ConflictError
 
 histfile = '.slipsomat_history'
+
+# Exit codes of the non-interactive commands
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_CONFLICT = 2
+EXIT_INVALID = 3
 try:
     import readline
     # Remove some standard delimiters like "/".
@@ -31,24 +45,57 @@ class Shell(Cmd):
     prompt = "\001\033[1;36m\002slipsomat>\001\033[0m\002 "
     file = None
 
-    def __init__(self):
+    def __init__(self, interactive=True, offline=False):
         """
         Construct a new Shell object.
 
         Params:
-            browser: Browser object for command dispatch
+            interactive: If False, exceptions are raised instead of offering to debug or restart
+            offline: If True, only the commands that don't need Alma can be used, and
+                slipsomat.cfg is not read
         """
         super(Shell, self).__init__()
         print('Starting slipsomat {}'.format(__version__))
 
-        self.worker = Worker('slipsomat.cfg')
-        self.worker.connect()
+        self.interactive = interactive
         self.status_file = StatusFile()
         self.local_storage = LocalStorage(self.status_file)
+        self.renderer = None
+        self.deps = DependencyGraph()
+        self.history = HistoryStore()
+
+        if offline:
+            self.worker = self.pool = self.fetcher = self.remote_index = self.testpage = self.table = None
+            return
+
+        self.worker = Worker('slipsomat.cfg')
+        self.pool = WorkerPool(self.worker)
+        self.fetcher = None
+        if self.worker.config.getboolean('http', 'fast_path'):
+            self.fetcher = HttpFetcher(self.worker)
+        self.remote_index = RemoteIndex(self.worker.instance,
+                                        float(self.worker.config.get('pull', 'recheck_interval')))
+        self.testpage = TestPage(self.worker)
+
+        # Start from the last table snapshot if we have one, and only start the browser
+        # when a command actually needs Alma.
+        self.table = TemplateConfigurationTable.from_snapshot(self.worker)
+        if self.table is None:
+            self.table = TemplateConfigurationTable(self.worker, read=False)
+            if self.interactive:
+                self.connect()
+        else:
+            print('Using the table as read {:%Y-%m-%d %H:%M}. It will be refreshed when needed.'.format(
+                self.table.read_at))
+
+    def connect(self):
+        """Start the browser and refresh the table, unless that has already been done."""
+        if self.worker.driver is not None:
+            return
+        self.worker.connect()
         sys.stdout.write('Reading table... ')
         sys.stdout.flush()
-        self.table = TemplateConfigurationTable(self.worker)
-        self.testpage = TestPage(self.worker)
+        self.table.open(force_read=True)
         sys.stdout.write('\rReading table... DONE\n')
 
     @staticmethod
@@ -68,16 +115,83 @@ class Shell(Cmd):
 
     def do_exit(self, arg):
         """Exit the program."""
-        self.worker.close()
+        self.pool.close()
         sys.exit()
 
+    def help_pull(self):
+        print(dedent("""
+        pull
+
+            Pull in letters modified directly in Alma.
+
+        pull --resume
+
+            Continue an interrupted pull, skipping the letters it already completed.
+
+        pull --all
+
+            Open every letter, also those that seem unchanged.
+        """))
+
     def do_pull(self, arg):
-        """Pull in letters modified directly in Alma."""
-        self.execute(pull, self.table, self.local_storage, self.status_file)
+        args = shlex.split(arg)
+        self.execute_remote(pull, self.table, self.local_storage, self.status_file, self.pool, self.fetcher,
+                            resume='--resume' in args, remote_index=self.remote_index, check_all='--all' in args)
+
+    def help_defaults(self):
+        print(dedent("""
+        defaults
+
+            Pull in updates to default letters.
+
+        defaults --resume
+
+            Continue an interrupted defaults run, skipping the letters it already completed.
+
+        Every version of the default letters seen is kept, see "help history".
+        """))
 
     def do_defaults(self, arg):
-        """Pull in updates to default letters."""
-        self.execute(pull_defaults, self.table, self.local_storage, self.status_file)
+        resume = arg.strip() == '--resume'
+        self.execute_remote(pull_defaults, self.table, self.local_storage, self.status_file, self.pool, self.fetcher,
+                            resume=resume, history=self.history)
+
+    def help_history(self):
+        print(dedent("""
+        history changed <date>
+
+            List the default letters that have changed since a date, like 2020-01-31.
+            Does not need the browser.
+
+        history log <filename>
+
+            List the versions seen of the default version of a letter.
+
+        history merge <filename> [<checksum>]
+
+            Merge the latest changes to the default version of a letter into the
+            local letter in xsl/letters. The changes are taken from the default
+            version with the checksum given, or else from the version before the
+            latest one. Conflicting changes are marked like in git.
+
+        The history is updated by the defaults command.
+        """))
+
+    def do_history(self, arg):
+        args = shlex.split(arg)
+        if len(args) == 2 and args[0] == 'changed':
+            try:
+                since = date_parser.parse(args[1])
+            except (ValueError, OverflowError):
+                print('Error: Invalid date: {}'.format(args[1]))
+                return
+            self.execute(changed_defaults, self.history, since)
+        elif len(args) == 2 and args[0] == 'log':
+            self.execute(print_log, self.history, 'xsl/letters/%s' % args[1])
+        elif len(args) in (2, 3) and args[0] == 'merge':
+            self.execute(merge_default, self.history, self.local_storage, 'xsl/letters/%s' % args[1], *args[2:])
+        else:
+            self.help_history()
 
     def help_push(self):
         print(dedent("""
@@ -94,7 +208,21 @@ class Shell(Cmd):
 
     def do_push(self, arg):
         files = ['xsl/letters/%s' % filename for filename in shlex.split(arg)]
-        self.execute(push, self.table, self.local_storage, self.status_file, files)
+        self.execute_remote(push, self.table, self.local_storage, self.status_file, files,
+                            pool=self.pool, fetcher=self.fetcher, remote_index=self.remote_index)
+
+    def do_modified(self, arg):
+        """List letters with local changes not yet pushed to Alma. Does not need the browser."""
+        with self.status_file.batch():
+            files = [filename for filename in self.table.filenames if self.local_storage.is_modified(filename)]
+        if len(files) == 0:
+            print('Found no modified files.')
+        for filename in files:
+            print(' - {}'.format(filename.replace('xsl/letters/', '')))
+
+    def do_check(self, arg):
+        """Validate all local letters and compare them with status.json. Does not need the browser."""
+        self.execute(check, self.status_file, deps=self.deps)
 
     def complete_push(self, word, line, begin_idx, end_idx):
         """Complete push arguments."""
@@ -108,6 +236,23 @@ class Shell(Cmd):
             the Alma Notification Template and storing screenshots of the resulting
             output.
 
+        test <filename>@<lang> --local
+
+            Render the letters locally with lxml instead of in Alma. This is much
+            faster and doesn't need the browser, but gives no screenshots. The output
+            is saved as <filename>_<lang>_local.html.
+
+        test <filename>@<lang> --affected
+
+            Only run tests for XML files using letters with local changes, or letters
+            including files with local changes, like header.xsl. Most useful together
+            with --local.
+
+        test <filename>@<lang> --force
+
+            Also run tests where neither the XML file nor the letters in Alma have
+            changed since the output was saved. These are skipped by default.
+
         Parameters:
             - <filename> can be either a single filename in the 'test-data' folder
               or a glob pattern like '*.xml'
@@ -115,7 +260,9 @@ class Shell(Cmd):
               separated by comma. Defaults to "en" if not specified.
         """))
 
-    def do_test(self, arg):
+    @staticmethod
+    def parse_test_arg(arg):
+        """Parse a "<filename>@<lang>" argument into a list of files and a list of languages."""
         languages = 'en'
         if '@' in arg:
             files, languages = arg.split('@')
@@ -123,17 +270,79 @@ class Shell(Cmd):
             files = arg
         languages = languages.split(',')
         files = glob(os.path.abspath(os.path.join('test-data', files)))
+        return files, languages
+
+    def get_renderer(self):
+        """Return the LocalRenderer, creating it on first use so its stylesheet cache is kept between tests."""
+        if self.renderer is None:
+            self.renderer = LocalRenderer()
+        return self.renderer
+
+    def affected_tests(self, files):
+        """Return the test files that use letters with local changes, or letters including such files."""
+        self.deps.update()
+        changed = [filename for filename in self.deps.letters if self.local_storage.is_modified(filename)]
+        affected = set(os.path.abspath(filename) for filename in self.deps.affected(changed)[1])
+        return [filename for filename in files if os.path.abspath(filename) in affected]
+
+    def do_test(self, arg):
+        flags = ('--force', '--local', '--affected')
+        args = shlex.split(arg)
+        files, languages = self.parse_test_arg(' '.join(a for a in args if a not in flags))
 
         if len(files) == 0:
             print('Error: No such file')
             return
 
-        self.execute(test, self.testpage, files, languages)
+        if '--affected' in args:
+            files = self.affected_tests(files)
+            if len(files) == 0:
+                print('No test files are affected by local changes.')
+                return
+
+        if '--local' in args:
+            try:
+                renderer = self.get_renderer()
+            except RuntimeError as e:
+                print('Error: {}'.format(e))
+                return
+            self.execute(test, self.testpage, files, languages, renderer=renderer)
+        else:
+            self.execute_remote(test, self.testpage, files, languages, self.pool,
+                                RenderCache(self.status_file, self.deps.update()), '--force' in args)
 
     def complete_test(self, word, line, begin_idx, end_idx):
         """Complete test arguments."""
         return self.completion_helper('test-data/', word, '.xml')
 
+    def help_stats(self):
+        print(dedent("""
+        stats
+
+            Show how much time has been spent in each operation, and how many
+            WebDriver round trips each made, since slipsomat was started.
+
+        stats export <filename>
+
+            Write all recorded timing spans to a JSON lines file for offline analysis.
+
+        stats reset
+
+            Forget all recorded timings.
+        """))
+
+    def do_stats(self, arg):
+        args = shlex.split(arg)
+        if len(args) == 0:
+            stats.print_summary()
+        elif args[0] == 'export' and len(args) == 2:
+            count = stats.export(args[1])
+            print('Wrote {} spans to {}'.format(count, args[1]))
+        elif args[0] == 'reset' and len(args) == 1:
+            stats.reset()
+        else:
+            self.help_stats()
+
     # Aliases
     do_EOF = do_exit  # ctrl-d
     do_eof = do_EOF
@@ -164,10 +373,10 @@ class Shell(Cmd):
             import pdb
             pdb.post_mortem()
         elif answer == 'Restart browser':
-            self.worker.restart()
+            self.pool.restart()
             return
 
-        self.worker.close()
+        self.pool.close()
         sys.exit()
 
     def preloop(self):
@@ -175,25 +384,167 @@ class Shell(Cmd):
             readline.read_history_file(histfile)
 
     def execute(self, fn, *args, **kwargs):
-        """Execute the function and handle any exceptions."""
-        if readline is not None:
+        """Execute the function and return its result, handling any exceptions if interactive."""
+        if self.interactive and readline is not None:
             readline.set_history_length(10000)
             readline.write_history_file(histfile)
         try:
-            fn(*args, **kwargs)
+            with self.status_file.batch():
+                return fn(*args, **kwargs)
         except Exception as e:
+            if not self.interactive:
+                raise
             self.handle_exception(e)
 
+    def execute_remote(self, fn, *args, **kwargs):
+        """Execute a function that needs the browser, starting it first if needed."""
+        if self.worker.driver is None:
+            try:
+                self.connect()
+            except Exception as e:
+                if not self.interactive:
+                    raise
+                self.handle_exception(e)
+                return
+        return self.execute(fn, *args, **kwargs)
+
     def precmd(self, line):
         """Process the command part of the input before it is sent to onecmd."""
         return line.strip()
 
 
-def main():
-    if not os.path.exists('slipsomat.cfg'):
+def needs_alma(args):
+    """Return True if the command given on the command line needs Alma, and so slipsomat.cfg."""
+    return not (args.command == 'check' or (args.command == 'test' and args.local))
+
+
+def run_command(shell, args):
+    """Run a single command with the parsed command line arguments, and return the exit code and result."""
+    on_conflict = 'fail' if args.fail_on_conflict else 'skip' if args.yes else 'ask'
+    shell.local_storage.on_conflict = on_conflict
+
+    if args.command == 'pull':
+        result = shell.execute_remote(pull, shell.table, shell.local_storage, shell.status_file, shell.pool,
+                                      shell.fetcher, resume=args.resume, remote_index=shell.remote_index,
+                                      check_all=args.all)
+        return (EXIT_CONFLICT if len(result['conflicts']) != 0 else EXIT_OK), result
+
+    if args.command == 'defaults':
+        result = shell.execute_remote(pull_defaults, shell.table, shell.local_storage, shell.status_file,
+                                      shell.pool, shell.fetcher, resume=args.resume, history=shell.history)
+        return EXIT_OK, result
+
+    if args.command == 'push':
+        files = ['xsl/letters/%s' % filename for filename in args.files]
+        result = shell.execute_remote(push, shell.table, shell.local_storage, shell.status_file, files,
+                                      assume_yes=args.yes, on_conflict=on_conflict, pool=shell.pool,
+                                      fetcher=shell.fetcher, remote_index=shell.remote_index)
+        if len(result['conflicts']) != 0:
+            return EXIT_CONFLICT, result
+        return (EXIT_ERROR if len(result['not_found']) != 0 else EXIT_OK), result
+
+    if args.command == 'test':
+        files, languages = shell.parse_test_arg(args.files)
+        if len(files) == 0:
+            raise RuntimeError('No such file: {}'.format(args.files))
+        if args.affected:
+            files = shell.affected_tests(files)
+            if len(files) == 0:
+                return EXIT_OK, {'outputs': [], 'unchanged': [], 'failed': []}
+        if args.local:
+            result = shell.execute(test, shell.testpage, files, languages, renderer=shell.get_renderer())
+        else:
+            result = shell.execute_remote(test, shell.testpage, files, languages, shell.pool,
+                                          RenderCache(shell.status_file, shell.deps.update()), args.force)
+        return (EXIT_ERROR if len(result['failed']) != 0 else EXIT_OK), result
+
+    if args.command == 'check':
+        result = shell.execute(check, shell.status_file, deps=shell.deps)
+        return (EXIT_INVALID if len(result['invalid']) != 0 else EXIT_OK), result
+
+
+def run(args):
+    """
+    Run a single command non-interactively and return the exit code.
+
+    With --json, a report is written to stdout, and all other output goes to stderr.
+    """
+    stdout = sys.stdout
+    if args.json:
+        sys.stdout = sys.stderr
+
+    shell = None
+    report = {'command': args.command, 'result': None, 'error': None}
+    try:
+        shell = Shell(interactive=False, offline=not needs_alma(args))
+        exit_code, report['result'] = run_command(shell, args)
+    except ConflictError as e:
+        print('\nConflict:', e)
+        exit_code = EXIT_CONFLICT
+        report['error'] = str(e)
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        exit_code = EXIT_ERROR
+        report['error'] = str(e)
+    finally:
+        if shell is not None and shell.pool is not None:
+            shell.pool.close()
+        sys.stdout = stdout
+
+    if args.json:
+        report['exit_code'] = exit_code
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    return exit_code
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='slipsomat',
+        description='Edit Alma letters. Start the interactive shell if no command is given.')
+    parser.add_argument('--version', action='version', version='slipsomat {}'.format(__version__))
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', action='store_true',
+                        help='write a JSON report to stdout, and all other output to stderr')
+    common.add_argument('--yes', '-y', action='store_true',
+                        help="don't ask for confirmation, and skip letters with conflicts")
+    common.add_argument('--fail-on-conflict', action='store_true',
+                        help='stop with exit code {} on the first conflict'.format(EXIT_CONFLICT))
+
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    command = commands.add_parser('pull', parents=[common], help='pull in letters modified directly in Alma')
+    command.add_argument('--resume', action='store_true', help='continue an interrupted pull')
+    command.add_argument('--all', action='store_true', help='open every letter, also those that seem unchanged')
+    command = commands.add_parser('defaults', parents=[common], help='pull in updates to default letters')
+    command.add_argument('--resume', action='store_true', help='continue an interrupted defaults run')
+    command = commands.add_parser('push', parents=[common], help='push locally modified letters to Alma')
+    command.add_argument('files', nargs='*', help='filenames relative to xsl/letters. Defaults to all modified')
+    command = commands.add_parser('test', parents=[common], help='test letter output in Alma')
+    command.add_argument('files', metavar='filename@lang',
+                         help='file(s) in test-data and languages, e.g. "*.xml@en,nn"')
+    command.add_argument('--force', action='store_true', help='also run tests whose inputs have not changed')
+    command.add_argument('--local', action='store_true', help='render the letters locally instead of in Alma')
+    command.add_argument('--affected', action='store_true',
+                         help='only test files using letters with local changes, directly or through includes')
+    commands.add_parser('check', parents=[common], help='validate local letters, without the browser')
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    if (args.command is None or needs_alma(args)) and not os.path.exists('slipsomat.cfg'):
         print('No slipsomat.cfg file found in this directory. Exiting.')
+        if args.command is not None:
+            sys.exit(EXIT_ERROR)
         return
 
+    if args.command is not None:
+        sys.exit(run(args))
+
     shell = Shell()
     shell.cmdloop()
 
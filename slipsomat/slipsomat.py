@@ -4,21 +4,29 @@ from __future__ import print_function
 import os
 import os.path
 import re
-import time
 import sys
+import time
 import hashlib
 import json
 import difflib
 import tempfile
+import threading
+import weakref
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.remote.errorhandler import NoSuchElementException
+from selenium.common.exceptions import TimeoutException
 from xml.etree import ElementTree
 from colorama import Fore, Back, Style
+import questionary
+
+from .stats import timed
 
 try:
     input = raw_input  # Python 2
@@ -32,6 +40,27 @@ def normalize_line_endings(text):
     return text.replace('\r\n', '\n').replace('\r', '\n').strip()
 
 
+def atomic_write(filename, data):
+    """
+    Write bytes to a file by writing to a temporary file and renaming it.
+
+    A crash halfway through the write leaves the original file untouched.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_filename, os.stat(filename).st_mode if os.path.exists(filename) else 0o644)
+        os.replace(tmp_filename, filename)
+    except Exception:
+        os.remove(tmp_filename)
+        raise
+
+
 def color_diff(diff):
     for line in diff:
         if line.startswith('+'):
@@ -44,12 +73,28 @@ def color_diff(diff):
             yield line
 
 
-def resolve_conflict(filename, local_content, remote_content, msg):
+class ConflictError(Exception):
+    """Raised on conflicts when they should fail the command rather than be resolved."""
+
+
+def resolve_conflict(filename, local_content, remote_content, msg, on_conflict='ask'):
+    """
+    Handle a conflict, and return True if the operation should continue.
+
+    Params:
+        on_conflict: "ask" to ask the user, "skip" to skip the letter, or "fail" to raise a ConflictError
+    """
+    if on_conflict == 'fail':
+        raise ConflictError('{}: {}'.format(filename, msg))
+
     print()
     print(
         '\n' + Back.RED + Fore.WHITE + '\n\n  Conflict: ' + msg + '\n' + Style.RESET_ALL
     )
 
+    if on_conflict == 'skip':
+        return False
+
     msg = 'Continue with {}?'.format(filename)
     while True:
         response = input(Fore.CYAN + "%s [y: yes, n: no, d: diff] " % msg + Style.RESET_ALL).lower()[:1]
@@ -59,6 +104,45 @@ def resolve_conflict(filename, local_content, remote_content, msg):
             return response == 'y'
 
 
+def resolve_conflicts(conflicts, msg, on_conflict='ask'):
+    """
+    Report several conflicts at once, and return the filenames the operation should continue for.
+
+    When asking, the user can continue for all the letters, for none of them, or pick the
+    letters one by one.
+
+    Params:
+        conflicts: list of (filename, local_content, remote_content) tuples
+        msg: description of the conflicts
+        on_conflict: "ask" to ask the user, "skip" to skip the letters, or "fail" to raise a ConflictError
+    """
+    filenames = [filename for filename, local_content, remote_content in conflicts]
+    if on_conflict == 'fail':
+        raise ConflictError('{}: {}'.format(', '.join(filenames), msg))
+
+    print()
+    print('\n' + Back.RED + Fore.WHITE + '\n\n  Conflicts: ' + msg + '\n' + Style.RESET_ALL)
+    for filename in filenames:
+        print(' - {}'.format(filename))
+
+    if on_conflict == 'skip':
+        return []
+
+    msg = 'Overwrite the {} letter(s) above?'.format(len(conflicts))
+    while True:
+        response = input(Fore.CYAN + "%s [y: all, n: none, s: select, d: diff] " % msg + Style.RESET_ALL).lower()[:1]
+        if response == 'd':
+            for filename, local_content, remote_content in conflicts:
+                print('\n' + Style.BRIGHT + filename + Style.RESET_ALL)
+                show_diff(remote_content, local_content)
+        elif response == 's':
+            return questionary.checkbox('Select the letters to overwrite:', choices=filenames).ask() or []
+        elif response == 'y':
+            return filenames
+        else:
+            return []
+
+
 def show_diff(dst, src):
     src = src.text.strip().splitlines()
     dst = dst.text.strip().splitlines()
@@ -70,39 +154,94 @@ def show_diff(dst, src):
 
 class LetterContent(object):
 
+    # Remote letters with identical contents share one instance, see intern()
+    interned = weakref.WeakValueDictionary()
+    interned_lock = threading.Lock()
+
     def __init__(self, text, filename=None):
         self.text = text.replace('\r\n', '\n').replace('\r', '\n').strip()
         self.filename = filename
-        self.validate()
+        self._sha1 = None
+        self._valid = None
+
+    @classmethod
+    def intern(cls, text):
+        """Return a LetterContent object for the text, reusing an existing object with the same contents."""
+        content = cls(text)
+        with cls.interned_lock:
+            return cls.interned.setdefault(content.sha1, content)
 
     @property
     def sha1(self):
-        m = hashlib.sha1()
-        m.update(self.text.encode('utf-8'))
-        return m.hexdigest()
+        if self._sha1 is None:
+            m = hashlib.sha1()
+            m.update(self.text.encode('utf-8'))
+            self._sha1 = m.hexdigest()
+        return self._sha1
+
+    def parse_error(self):
+        """
+        Return the error message if the letter is not well-formed XML, or None if it is.
+
+        Parsing is only done on the first call.
+        """
+        if self._valid is None:
+            self._valid = True
+            if self.text != '':
+                try:
+                    ElementTree.fromstring(self.text)
+                except ElementTree.ParseError as e:
+                    self._valid = str(e)
+        return None if self._valid is True else self._valid
 
     def validate(self):
-        if self.text == '':
-            return
-        try:
-            ElementTree.fromstring(self.text)
-        except ElementTree.ParseError as e:
+        """Check that the letter is well-formed XML, and print an error if it's not. Returns True if valid."""
+        error = self.parse_error()
+        if error is not None:
             print('%sError: %s contains invalid XML:%s' % (Fore.RED, self.filename or 'The letter', Style.RESET_ALL))
-            print(Fore.RED + str(e) + Style.RESET_ALL)
-            return
+            print(Fore.RED + error + Style.RESET_ALL)
+        return error is None
 
 
 class LocalStorage(object):
     """File storage abstraction class."""
 
-    def __init__(self, status_file):
+    def __init__(self, status_file, on_conflict='ask'):
+        """
+        Construct a new LocalStorage object.
+
+        Params:
+            status_file: StatusFile object
+            on_conflict: How to handle local changes that would be overwritten, see resolve_conflict()
+        """
         self.status_file = status_file
+        self.on_conflict = on_conflict
 
     def is_modified(self, filename):
-        """Return True if the letter has local changes not yet pushed to Alma."""
+        """
+        Return True if the letter has local changes not yet pushed to Alma.
+
+        If the size and modification times of the file are the same as the last time the
+        file was found to match the checksum in status.json, the file is not read at all.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+
+        checksum = self.status_file.checksum(filename)
+        if checksum is not None and self.status_file.file_stat_matches(filename, stat, checksum):
+            return False
+
         local_content = self.get_content(filename)
-        return local_content.text != '' and local_content.sha1 != self.status_file.checksum(filename)
+        if local_content.text == '':
+            return False
+        if local_content.sha1 == checksum:
+            self.status_file.set_file_stat(filename, stat, checksum)
+            return False
+        return True
 
+    @timed('storage.get_content')
     def get_content(self, filename):
         """
         Read the contents of a letter from disk and return it as a LetterContent object.
@@ -114,6 +253,7 @@ class LocalStorage(object):
         with open(filename, 'rb') as fp:
             return LetterContent(fp.read().decode('utf-8'), filename=filename)
 
+    @timed('storage.store')
     def store(self, filename, content, modified):
         """
         Store the contents of a letter to disk.
@@ -124,10 +264,11 @@ class LocalStorage(object):
             os.makedirs(os.path.dirname(filename))
 
         local_content = self.get_content(filename)
-        if local_content.text != '' and local_content.sha1 != self.status_file.checksum(filename):
+        if local_content.text not in ('', content.text) and local_content.sha1 != self.status_file.checksum(filename):
             # The local file has been changed
             if not resolve_conflict(filename, content, local_content,
-                                    'Pulling in this file would cause local changes to be overwritten.'):
+                                    'Pulling in this file would cause local changes to be overwritten.',
+                                    self.on_conflict):
                 return False
 
         # Actually store the contents to disk
@@ -137,9 +278,11 @@ class LocalStorage(object):
         # Update the status file
         self.status_file.set_checksum(filename, content.sha1)
         self.status_file.set_modified(filename, modified)
+        self.status_file.set_file_stat(filename, os.stat(filename), content.sha1)
 
         return True
 
+    @timed('storage.store_default')
     def store_default(self, filename, content):
         """
         Store the contents of a default letter to disk.
@@ -159,6 +302,10 @@ class LocalStorage(object):
 
 class StatusFile(object):
 
+    # The sizes and modification times of the letters are machine specific, so they
+    # are kept outside of status.json, which is usually under version control.
+    file_stats_file = '.slipsomat_stat.json'
+
     def __init__(self):
         letters = {}
         if os.path.exists('status.json'):
@@ -166,8 +313,42 @@ class StatusFile(object):
                 contents = json.load(fp)
             letters = contents['letters']
 
+        file_stats = {}
+        if os.path.exists(self.file_stats_file):
+            try:
+                with open(self.file_stats_file) as fp:
+                    file_stats = json.load(fp)
+            except ValueError:
+                pass
+
         self.letters = letters
+        self.file_stats = file_stats
+        self.file_stats_unsaved = False
+        self.batch_depth = 0
+        self.flush_every = None
+        self.unsaved = set()
+
+    @contextmanager
+    def batch(self, flush_every=10):
+        """
+        Keep changes in memory and save them when the block exits.
 
+        To limit the work lost if the process is killed, the changes are also saved every
+        time `flush_every` letters have changed. Nested batches are part of the outermost one.
+        """
+        if self.batch_depth == 0:
+            self.flush_every = flush_every
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0 and len(self.unsaved) != 0:
+                self.save()
+            elif self.batch_depth == 0 and self.file_stats_unsaved:
+                self.save_file_stats()
+
+    @timed('status.save')
     def save(self):
         data = {
             'version': 1,
@@ -181,8 +362,29 @@ class StatusFile(object):
         # Normalize to unix line endings
         jsondump = normalize_line_endings(jsondump)
 
-        with open('status.json', 'wb') as fp:
-            fp.write(jsondump.encode('utf-8'))
+        atomic_write('status.json', jsondump.encode('utf-8'))
+        self.unsaved.clear()
+
+        if self.file_stats_unsaved:
+            self.save_file_stats()
+
+    def save_file_stats(self):
+        atomic_write(self.file_stats_file, json.dumps(self.file_stats, sort_keys=True).encode('utf-8'))
+        self.file_stats_unsaved = False
+
+    def file_stat_matches(self, filename, stat, checksum):
+        """Return True if the file is unchanged since it was last found to have the given checksum."""
+        return self.file_stats.get(filename) == [stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, checksum]
+
+    def set_file_stat(self, filename, stat, checksum):
+        """Remember that a file with the given size and modification times has the given checksum."""
+        # If the file was modified just now, it could be modified again without the
+        # modification time changing, so wait until the next check to trust it.
+        if time.time() - stat.st_mtime < 2:
+            self.file_stats.pop(filename, None)
+        else:
+            self.file_stats[filename] = [stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, checksum]
+        self.file_stats_unsaved = True
 
     def get(self, filename, property, default=None):
         if filename not in self.letters:
@@ -193,7 +395,9 @@ class StatusFile(object):
         if filename not in self.letters:
             self.letters[filename] = {}
         self.letters[filename][property] = value
-        self.save()
+        self.unsaved.add(filename)
+        if self.batch_depth == 0 or (self.flush_every and len(self.unsaved) >= self.flush_every):
+            self.save()
 
     def modified(self, filename):
         return self.get(filename, 'modified')
@@ -216,17 +420,257 @@ class StatusFile(object):
         self.set(filename, 'default_checksum', checksum)
 
 
+class ProgressJournal(object):
+    """
+    A record of the letters completed so far by a pull or defaults run.
+
+    Each completed letter is appended to a JSON lines file together with its checksum,
+    so that an interrupted run can be resumed. The file is removed when the run completes.
+    """
+
+    def __init__(self, command, resume=False):
+        """
+        Construct a new ProgressJournal object.
+
+        Params:
+            command: Name of the command, e.g. "pull"
+            resume: Whether to continue from an existing journal instead of starting over
+        """
+        self.filename = '.slipsomat_progress_{}.jsonl'.format(command)
+        self.completed = {}
+
+        if resume and os.path.isfile(self.filename):
+            with open(self.filename) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # A partially written last line
+                    if 'filename' in entry:
+                        self.completed[entry['filename']] = entry['sha1']
+            self.fp = open(self.filename, 'a')
+        else:
+            self.fp = open(self.filename, 'w')
+            self.fp.write(json.dumps({'command': command, 'started': datetime.now().isoformat()}) + '\n')
+            self.fp.flush()
+
+    @staticmethod
+    def exists(command):
+        return os.path.isfile('.slipsomat_progress_{}.jsonl'.format(command))
+
+    def is_completed(self, filename, sha1):
+        """Return True if the letter was completed with the given checksum."""
+        return sha1 is not None and self.completed.get(filename) == sha1
+
+    def add(self, filename, sha1):
+        self.completed[filename] = sha1
+        self.fp.write(json.dumps({'filename': filename, 'sha1': sha1}) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+    def finish(self):
+        """Close and remove the journal after a completed run."""
+        self.close()
+        os.remove(self.filename)
+
+
+class RemoteIndex(object):
+    """
+    What was last seen of each letter in Alma.
+
+    For each letter, the update date and user from the table (the fingerprint), the checksum
+    of the contents and the time the letter was last opened are kept. A letter only needs to be
+    opened again if its fingerprint has changed, or if it has been updated today, since the
+    update date has no time of day, and it was opened more than `recheck_interval` seconds ago.
+    The index is machine specific, and kept outside of status.json.
+    """
+
+    filename = '.slipsomat_remote.json'
+
+    def __init__(self, instance, recheck_interval=900):
+        """
+        Construct a new RemoteIndex object.
+
+        Params:
+            instance: Alma instance name
+            recheck_interval: How often to check letters updated today, in seconds
+        """
+        self.instance = instance
+        self.recheck_interval = recheck_interval
+        self.letters = {}
+        self.unsaved = False
+        try:
+            with open(self.filename) as fp:
+                data = json.load(fp)
+            if data.get('version') == 1 and data.get('instance') == instance:
+                self.letters = data['letters']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def fingerprint(table, filename):
+        return [table.modified(filename), table.rows[filename].updated_by]
+
+    def is_unchanged(self, table, filename, checksum, today):
+        """Return True if the letter in Alma is known to have the given checksum, without opening it."""
+        entry = self.letters.get(filename)
+        if entry is None or checksum is None or entry['checksum'] != checksum:
+            return False
+        fingerprint = self.fingerprint(table, filename)
+        if entry['fingerprint'] != fingerprint:
+            return False
+        return fingerprint[0] != today or time.time() - entry['checked'] < self.recheck_interval
+
+    def set(self, table, filename, checksum):
+        """Record the checksum of a letter as just seen in Alma."""
+        self.letters[filename] = {
+            'fingerprint': self.fingerprint(table, filename),
+            'checksum': checksum,
+            'checked': time.time(),
+        }
+        self.unsaved = True
+
+    def save(self):
+        if not self.unsaved:
+            return
+        data = json.dumps({'version': 1, 'instance': self.instance, 'letters': self.letters}, sort_keys=True)
+        atomic_write(self.filename, data.encode('utf-8'))
+        self.unsaved = False
+
+
+class TableRow(object):
+    """A letter in the "Customize letters" table."""
+
+    __slots__ = ('index', 'filename', 'modified', 'updated_by', 'view_url', 'view_default_url')
+
+    def __init__(self, index, filename, modified, updated_by, view_url=None, view_default_url=None):
+        self.index = index
+        self.filename = filename
+        self.modified = modified
+        self.updated_by = updated_by
+        self.view_url = view_url
+        self.view_default_url = view_default_url
+
+    @property
+    def customized(self):
+        return self.updated_by not in ('-', 'Network')
+
+
 class TemplateConfigurationTable(object):
     """Interface to "Customize letters" in Alma."""
 
-    def __init__(self, worker):
+    # Reads the filename, update date and updated by columns of the table in a single
+    # WebDriver round trip, instead of one round trip per cell. We also collect the
+    # targets of the "view" and "view default" links, for HttpFetcher.
+    read_script = """
+        var table = document.getElementById('TABLE_DATA_fileList');
+        var headers = Array.prototype.map.call(table.querySelectorAll('tr > th'), function (th) {
+            return th.id;
+        });
+        var missing = ['SELENIUM_ID_fileList_HEADER_cfgFilefilename', 'SELENIUM_ID_fileList_HEADER_updateDate']
+            .filter(function (id) { return headers.indexOf(id) === -1; });
+        if (missing.length !== 0) {
+            return JSON.stringify({error: 'Column not found in the letters table: ' + missing.join(', ')});
+        }
+        var filenameCol = headers.indexOf('SELENIUM_ID_fileList_HEADER_cfgFilefilename') + 1;
+        var updateDateCol = headers.indexOf('SELENIUM_ID_fileList_HEADER_updateDate') + 1;
+        var text = function (el) {
+            return el ? (el.innerText || el.textContent).trim() : '';
+        };
+        var url = function (a) {
+            return (a && /^https?:/.test(a.href) && a.getAttribute('href').charAt(0) !== '#') ? a.href : null;
+        };
+        var filenames = table.querySelectorAll('tr > td:nth-child(' + filenameCol + ') > a');
+        var updateDates = table.querySelectorAll('tr > td:nth-child(' + updateDateCol + ') > span');
+        var rows = [];
+        for (var i = 0; i < filenames.length; i++) {
+            rows.push([
+                text(filenames[i]),
+                text(updateDates[i]),
+                text(document.getElementById('SPAN_SELENIUM_ID_fileList_ROW_' + i + '_COL_cfgFileupdatedBy')),
+                url(filenames[i]),
+                url(document.querySelector('[id="ROW_ACTION_fileList_' + i + '_c.ui.table.btn.view_default"] a'))
+            ]);
+        }
+        return JSON.stringify(rows);
+    """
+
+    # The last table read is kept here, so the shell can start without reading Alma
+    snapshot_file = '.slipsomat_table.json'
+
+    def __init__(self, worker, read=True, save_snapshot=True):
+        """
+        Construct a new TemplateConfigurationTable object.
+
+        Params:
+            worker: Worker object
+            read: Whether to open and read the table right away
+            save_snapshot: Whether to save a snapshot each time the table is read
+        """
+        self.rows = OrderedDict()
         self.filenames = []
-        self.update_dates = []
+        self.read_at = None
         self.worker = worker
-        self.open()
-        self.read()
+        self.saves_snapshot = save_snapshot
+        if read:
+            self.open(force_read=True)
+
+    @classmethod
+    def from_snapshot(cls, worker):
+        """Construct a table from the last saved snapshot, or return None if there is none."""
+        table = cls(worker, read=False)
+        if not table.load_snapshot():
+            return None
+        return table
+
+    def load_snapshot(self):
+        if not os.path.isfile(self.snapshot_file):
+            return False
+        try:
+            with open(self.snapshot_file) as fp:
+                snapshot = json.load(fp)
+        except ValueError:
+            return False
+        if snapshot.get('version') != 1 or snapshot.get('instance') != self.worker.instance:
+            return False
+
+        self.set_rows([
+            TableRow(row['index'], row['filename'], row['modified'], row['updated_by'],
+                     row['view_url'], row['view_default_url'])
+            for row in snapshot['rows']
+        ])
+        self.read_at = datetime.strptime(snapshot['read_at'], '%Y-%m-%dT%H:%M:%S')
+        return True
 
-    def open(self):
+    def save_snapshot(self):
+        snapshot = {
+            'version': 1,
+            'instance': self.worker.instance,
+            'read_at': self.read_at.strftime('%Y-%m-%dT%H:%M:%S'),
+            'rows': [
+                {
+                    'index': row.index,
+                    'filename': row.filename,
+                    'modified': row.modified,
+                    'updated_by': row.updated_by,
+                    'customized': row.customized,
+                    'view_url': row.view_url,
+                    'view_default_url': row.view_default_url,
+                }
+                for row in self.rows.values()
+            ],
+        }
+        atomic_write(self.snapshot_file, json.dumps(snapshot, indent=1, sort_keys=True).encode('utf-8'))
+
+    @timed('table.open')
+    def open(self, force_read=False):
+        """
+        Navigate to the table, unless we're already there.
+
+        The table is re-read if we had to navigate to it, or if `force_read` is True.
+        """
         try:
             self.worker.first(By.CSS_SELECTOR, '#TABLE_DATA_fileList')
         except NoSuchElementException:
@@ -240,17 +684,27 @@ class TemplateConfigurationTable(object):
             self.worker.click(By.XPATH, '//*[@href="#CONF_MENU6"]')
             self.worker.click(By.XPATH, '//*[text() = "Customize Letters"]')
             self.worker.wait_for(By.CSS_SELECTOR, '#TABLE_DATA_fileList')
+            force_read = True
+
+        if force_read:
+            self.read()
 
         return self
 
+    def set_rows(self, rows):
+        self.rows = OrderedDict((row.filename, row) for row in rows)
+        self.filenames = list(self.rows)
+
+    def __contains__(self, filename):
+        """Return True if the table has a letter with the given filename."""
+        return filename in self.rows
+
     def modified(self, filename):
-        idx = self.filenames.index(filename)
-        return self.update_dates[idx]
+        return self.rows[filename].modified
 
     def set_modified(self, filename, date):
         # Allow updating a single date instead of having to re-read the whole table
-        idx = self.filenames.index(filename)
-        self.update_dates[idx] = date
+        self.rows[filename].modified = date
 
     def print_letter_status(self, filename, msg, progress=None, newline=False):
         sys.stdout.write('\r{:100}'.format(''))  # We clear the line first
@@ -269,31 +723,36 @@ class TemplateConfigurationTable(object):
             sys.stdout.write('\n')
         sys.stdout.flush()
 
+    @timed('table.read')
     def read(self):
+        rows = json.loads(self.worker.driver.execute_script(self.read_script))
+        if isinstance(rows, dict):
+            # Don't continue with an empty table if Alma has changed the table layout
+            raise RuntimeError(rows['error'])
 
-        # Identify the indices of the column headers we're interested in
-        elems = self.worker.all(By.CSS_SELECTOR, '#TABLE_DATA_fileList tr > th')
-        column_headers = [el.get_attribute('id') for el in elems]
-        filename_col = column_headers.index('SELENIUM_ID_fileList_HEADER_cfgFilefilename') + 1
-        updatedate_col = column_headers.index('SELENIUM_ID_fileList_HEADER_updateDate') + 1
-
-        # Read the filename column
-        elems = self.worker.all(By.CSS_SELECTOR,
-                                '#TABLE_DATA_fileList tr > td:nth-child(%d) > a' % filename_col)
-        self.filenames = [el.text.replace('../', '') for el in elems]
-
-        # Read the modification date column
-        elems = self.worker.all(By.CSS_SELECTOR,
-                                '#TABLE_DATA_fileList tr > td:nth-child(%d) > span' % updatedate_col)
-        self.update_dates = [el.text for el in elems]
+        self.set_rows([
+            TableRow(index, row[0].replace('../', ''), *row[1:])
+            for index, row in enumerate(rows)
+        ])
+        self.read_at = datetime.now()
 
-        # return [{x[0]:2 {'modified': x[1], 'index': n}} for n, x in enumerate(zip(filenames, update_dates))]
+        # Only the main table is saved, not the tables of the other workers in a WorkerPool
+        if self.saves_snapshot:
+            self.save_snapshot()
 
     def is_customized(self, filename):
-        index = self.filenames.index(filename)
-        updated_by = self.worker.first(By.ID, 'SPAN_SELENIUM_ID_fileList_ROW_%d_COL_cfgFileupdatedBy' % index)
+        return self.rows[filename].customized
 
-        return updated_by.text not in ('-', 'Network')
+    def letter_url(self, filename):
+        """Return the URL of the page showing the current version of a letter, if known."""
+        return self.rows[filename].view_url
+
+    def default_letter_url(self, filename):
+        """Return the URL of the page showing the default version of a letter, if known."""
+        row = self.rows[filename]
+        if row.customized:
+            return row.view_default_url
+        return row.view_url
 
     def assert_filename(self, filename):
         # Assert that we are at the right letter
@@ -303,21 +762,35 @@ class TemplateConfigurationTable(object):
         elt = element.text.replace('../', '')
         assert elt == filename, "%r != %r" % (elt, filename)
 
+    def read_textarea(self):
+        """
+        Wait for the letter text area to be loaded and return its contents.
+
+        Waits for the text area to be populated, but only for the "letter_content" timeout,
+        since a letter can also be empty.
+        """
+        self.worker.wait.until(
+            EC.presence_of_element_located((By.ID, 'pageBeanfileContent'))
+        )
+        try:
+            return self.worker.waiter(self.worker.timeout('letter_content')).until(
+                lambda driver: driver.find_element(By.ID, 'pageBeanfileContent').text)
+        except TimeoutException:
+            return self.worker.first(By.ID, 'pageBeanfileContent').text
+
+    @timed('table.open_letter')
     def open_letter(self, filename):
         self.open()
 
         # Open a letter and return its contents as a LetterContent object.
-        index = self.filenames.index(filename)
+        index = self.rows[filename].index
         self.worker.wait.until(EC.presence_of_element_located(
             (By.ID, 'SELENIUM_ID_fileList_ROW_%d_COL_cfgFilefilename' % index))
         )
 
-        time.sleep(0.2)
-
-        # Open the "ellipsis" menu.
+        # Open the "ellipsis" menu. Clicking the menu items below waits for the menu to become visible.
         self.worker.scroll_into_view_and_click(
             '#input_fileList_{}'.format(index), By.CSS_SELECTOR)
-        time.sleep(0.2)
 
         if self.is_customized(filename):
             # Click "Edit" menu item
@@ -344,14 +817,14 @@ class TemplateConfigurationTable(object):
         # We should now be at the letter edit form. Assert that filename is indeed correct
         self.assert_filename(filename)
 
-        txtarea = self.worker.first(By.ID, 'pageBeanfileContent')
-        return LetterContent(txtarea.text)
+        return LetterContent.intern(self.read_textarea())
 
+    @timed('table.open_default_letter')
     def open_default_letter(self, filename):
         """Open a default letter and return its contents as a LetterContent object."""
         self.open()
 
-        index = self.filenames.index(filename)
+        index = self.rows[filename].index
         self.worker.wait.until(EC.presence_of_element_located(
             (By.ID, 'SELENIUM_ID_fileList_ROW_%d_COL_cfgFilefilename' % index)))
 
@@ -359,26 +832,22 @@ class TemplateConfigurationTable(object):
 
             # Open the "ellipsis" menu
             self.worker.scroll_into_view_and_click('input_fileList_%d' % index)
-            time.sleep(0.2)
 
-            # Click "View Default" menu item
+            # Click "View Default" menu item, once the menu is visible
             self.worker.scroll_into_view_and_click(
                 'ROW_ACTION_fileList_%d_c.ui.table.btn.view_default' % index)
-            time.sleep(0.2)
 
         else:
             # Click the filename
             self.worker.scroll_into_view_and_click(
                 '#SELENIUM_ID_fileList_ROW_%d_COL_cfgFilefilename a' % index, By.CSS_SELECTOR)
-            time.sleep(0.2)
 
         # Assert that filename is indeed correct
         self.assert_filename(filename)
 
-        # Read text area content
-        txtarea = self.worker.first(By.ID, 'pageBeanfileContent')
-        return LetterContent(txtarea.text)
+        return LetterContent.intern(self.read_textarea())
 
+    @timed('table.close_letter')
     def close_letter(self):
         # If we are at specific letter, press the "go back" button.
         elems = self.worker.all(By.CSS_SELECTOR, '.pageTitle')
@@ -398,6 +867,7 @@ class TemplateConfigurationTable(object):
 
             self.worker.wait_for(By.CSS_SELECTOR, '#TABLE_DATA_fileList')
 
+    @timed('table.put_contents')
     def put_contents(self, filename, content):
         """
         Save letter contents to Alma.
@@ -423,16 +893,128 @@ class TemplateConfigurationTable(object):
             btn = self.worker.first(By.ID, 'PAGE_BUTTONS_cbuttoncustomize')
         btn.click()
 
-        # Wait for the table view.
-        # Longer timeout per https://github.com/scriptotek/alma-slipsomat/issues/33
-        self.worker.wait_for(By.CSS_SELECTOR, '.typeD table', timeout=40)
+        # Wait for the table view. Saving can be slow, so this has its own timeout,
+        # see https://github.com/scriptotek/alma-slipsomat/issues/33
+        self.worker.wait_for(By.CSS_SELECTOR, '.typeD table', timeout=self.worker.timeout('save_letter'))
+
+        # The letter is now customized and has a new update date
+        self.open(force_read=True)
 
         return True
 
 
 # Commands ---------------------------------------------------------------------------------
 
-def pull_defaults(table, local_storage, status_file):
+def table_for(worker, table):
+    """
+    Return a TemplateConfigurationTable for a worker.
+
+    The table is reused if it already belongs to the worker, otherwise a table is opened
+    and cached on the worker, so that each browser in a WorkerPool gets its own table.
+    """
+    if worker is table.worker:
+        return table
+    if worker._template_table is None:
+        worker._template_table = TemplateConfigurationTable(worker, save_snapshot=False)
+    return worker._template_table
+
+
+def map_letters(table, fn, filenames, pool=None):
+    """
+    Call fn(table, filename) for each filename and yield (filename, result) tuples.
+
+    If a WorkerPool is given, the letters are spread across its workers, each working
+    on its own table in a separate thread, and the results are yielded in order of
+    completion. While the caller handles one result, the browsers move on to the next
+    letters.
+
+    Params:
+        table: TemplateConfigurationTable object
+        fn: function taking a TemplateConfigurationTable object and a filename
+        filenames: list of filenames
+        pool: WorkerPool object or None
+    """
+    if pool is None:
+        for filename in filenames:
+            yield filename, fn(table, filename)
+        return
+
+    refreshed = set()
+
+    def worker_table(worker):
+        if worker is not table.worker and worker not in refreshed:
+            # Letters may have been customized through another table since a table kept
+            # from an earlier command was read. New tables are read when they are created.
+            if worker._template_table is not None:
+                worker._template_table.open(force_read=True)
+            refreshed.add(worker)
+        return table_for(worker, table)
+
+    def work(worker, filename):
+        return fn(worker_table(worker), filename)
+
+    for filename, result in pool.imap_unordered(work, filenames):
+        yield filename, result
+
+
+def retry_letter(table, filename, fn):
+    """Call fn() and return its result, retrying according to the retry policy of the worker."""
+    return table.worker.retry(fn, lambda msg: table.print_letter_status(filename, msg))
+
+
+@timed('letter.fetch_default')
+def fetch_default_letter(table, filename):
+    """Open the default version of a letter, read its contents and go back to the table."""
+    content = retry_letter(table, filename, lambda: table.open_default_letter(filename))
+    table.close_letter()
+    return content
+
+
+@timed('letter.fetch')
+def fetch_letter(table, filename):
+    """Open the current version of a letter, read its contents and go back to the table."""
+    def open_letter():
+        if table.is_customized(filename):
+            return table.open_letter(filename)
+        return table.open_default_letter(filename)
+
+    content = retry_letter(table, filename, open_letter)
+    table.close_letter()
+    return content
+
+
+def read_letters(table, filenames, pool=None, fetcher=None, default=False):
+    """
+    Read the contents of letters and yield (filename, LetterContent) tuples.
+
+    If a HttpFetcher is given, letters are first fetched over HTTP, and the browser is
+    only used for the letters where that didn't work.
+
+    Params:
+        table: TemplateConfigurationTable object
+        filenames: list of filenames
+        pool: WorkerPool object or None
+        fetcher: HttpFetcher object or None
+        default: Whether to read the default versions of the letters
+    """
+    remaining = filenames
+    if fetcher is not None:
+        get_url = table.default_letter_url if default else table.letter_url
+        urls = [(filename, get_url(filename)) for filename in filenames]
+        remaining = [filename for filename, url in urls if url is None]
+        for filename, text in fetcher.fetch_many([(filename, url) for filename, url in urls if url is not None]):
+            if text is None:
+                remaining.append(filename)
+            else:
+                yield filename, LetterContent.intern(text)
+
+    fn = fetch_default_letter if default else fetch_letter
+    for filename, content in map_letters(table, fn, remaining, pool):
+        yield filename, content
+
+
+@timed('command.defaults')
+def pull_defaults(table, local_storage, status_file, pool=None, fetcher=None, resume=False, history=None):
     """
     Update the local copies of the default versions of the Alma letters.
 
@@ -440,52 +1022,77 @@ def pull_defaults(table, local_storage, status_file):
     If you keep the folder under version control, this allows you to detect changes in the
     default letters. Unfortunately, there is no way of knowing if a default letter has changed
     without actually opening it, so we have to open each and every letter. This takes some time
-    of course.
+    of course, but the work can be spread across several browsers using a WorkerPool.
 
     Params:
         table: TemplateConfigurationTable object
         local_storage: LocalStorage object
         status_file: StatusFile object
+        pool: WorkerPool object or None
+        fetcher: HttpFetcher object or None
+        resume: Whether to skip the letters completed by the last, interrupted run
+        history: HistoryStore object to record every version seen in, or None
+
+    Returns a dict with lists of new and changed letters.
     """
-    count_new = 0
-    count_changed = 0
-    for idx, filename in enumerate(table.filenames):
-        progress = '%d/%d' % ((idx + 1), len(table.filenames))
-        table.print_letter_status(filename, 'checking...', progress)
-        try:
-            content = table.open_default_letter(filename)
-        except TimeoutException:
-            # Retry once
-            table.print_letter_status(filename, 'retrying...', progress)
-            content = table.open_default_letter(filename)
+    result = {'new': [], 'changed': []}
+    count_checked = 0
+    journal = ProgressJournal('defaults', resume)
+    filenames = []
+    for filename in table.filenames:
+        if journal.is_completed(filename, status_file.default_checksum(filename)):
+            count_checked += 1
+            progress = '%d/%d' % (count_checked, len(table.filenames))
+            table.print_letter_status(filename, 'checked in previous run', progress, True)
+        else:
+            filenames.append(filename)
 
-        table.print_letter_status(filename, 'closing...', progress)
-        table.close_letter()
+    try:
+        for filename, content in read_letters(table, filenames, pool, fetcher, default=True):
+            count_checked += 1
+            progress = '%d/%d' % (count_checked, len(table.filenames))
 
-        old_sha1 = status_file.default_checksum(filename)
+            old_sha1 = status_file.default_checksum(filename)
+            if history is not None:
+                history.add(filename, content)
 
-        if content.sha1 == old_sha1:
-            table.print_letter_status(filename, 'no changes', progress, True)
-            continue
+            if content.sha1 == old_sha1:
+                journal.add(filename, content.sha1)
+                table.print_letter_status(filename, 'no changes', progress, True)
+                continue
 
-        # Write contents to default letter
-        local_storage.store_default(filename, content)
+            # Write contents to default letter
+            local_storage.store_default(filename, content)
+            journal.add(filename, content.sha1)
 
-        if old_sha1 is None:
-            count_new += 1
-            table.print_letter_status(filename, Fore.GREEN + 'fetched new letter @ {}'.format(
-                content.sha1[0:7]) + Style.RESET_ALL, progress, True)
-        else:
-            count_changed += 1
-            if old_sha1 == content.sha1:
-                table.print_letter_status(
-                    filename, Fore.GREEN + 'no changes' + Style.RESET_ALL, progress, True)
+            if old_sha1 is None:
+                result['new'].append(filename)
+                table.print_letter_status(filename, Fore.GREEN + 'fetched new letter @ {}'.format(
+                    content.sha1[0:7]) + Style.RESET_ALL, progress, True)
             else:
+                result['changed'].append(filename)
                 table.print_letter_status(filename, Fore.GREEN + 'updated from {} to {}'.format(
                     old_sha1[0:7], content.sha1[0:7]) + Style.RESET_ALL, progress, True)
-
+    except BaseException:
+        journal.close()
+        print('\nRun "defaults --resume" to continue where this run stopped.')
+        raise
+    finally:
+        if history is not None:
+            history.save()
+
+    journal.finish()
     sys.stdout.write(Fore.GREEN + 'Fetched {} new, {} changed default letters\n'.format(
-        count_new, count_changed) + Style.RESET_ALL)
+        len(result['new']), len(result['changed'])) + Style.RESET_ALL)
+
+    return result
+
+
+def set_preferred_language(data, lang):
+    """Return the bytes of a test XML file with the preferred language of the receiver set to `lang`."""
+    return re.sub('<preferred_language>[a-z]+</preferred_language>',
+                  '<preferred_language>%s</preferred_language>' % lang,
+                  data.decode('utf-8')).encode('utf-8')
 
 
 class TestPage(object):
@@ -507,14 +1114,20 @@ class TestPage(object):
 
             self.worker.wait_for(By.ID, 'cbuttonupload')
 
+    @timed('testpage.test')
     def test(self, filename, lang):
+        """
+        Run the test and save the output.
 
+        Returns a tuple with the path of the HTML output, and the path of the screenshot
+        or None if the screenshot failed. Raises RuntimeError if the file or language is
+        not found.
+        """
         self.open()
-        wait = self.worker.waiter()
+        wait = self.worker.waiter(self.worker.timeout('test'))
 
         if not os.path.isfile(filename):
-            print('%sERROR: File not found: %s%s' % (Fore.RED, filename, Fore.RESET))
-            return
+            raise RuntimeError('File not found: %s' % filename)
 
         file_root, file_ext = os.path.splitext(filename)
 
@@ -523,9 +1136,7 @@ class TestPage(object):
 
         tmp = tempfile.NamedTemporaryFile('wb')
         with open(filename, 'rb') as fp:
-            tmp.write(re.sub('<preferred_language>[a-z]+</preferred_language>',
-                             '<preferred_language>%s</preferred_language>' % lang,
-                             fp.read().decode('utf-8')).encode('utf-8'))
+            tmp.write(set_preferred_language(fp.read(), lang))
         tmp.flush()
 
         # Set language
@@ -535,8 +1146,7 @@ class TestPage(object):
         select = Select(element)
         opts = {el.get_attribute('value'): el.get_attribute('innerText') for el in select.options}
         if lang not in opts:
-            print('%sERROR: Language not found: %s%s' % (Fore.RED, lang, Fore.RESET))
-            return
+            raise RuntimeError('Language not found: %s' % lang)
 
         longLangName = opts[lang]
 
@@ -561,16 +1171,27 @@ class TestPage(object):
         )
 
         cwh = self.worker.driver.current_window_handle
+        handles = set(self.worker.driver.window_handles)
 
         run_btn.click()
-        time.sleep(1)
+
+        # Wait for the output window to open
+        wait.until(lambda driver: len(set(driver.window_handles) - handles) != 0)
+        new_handles = [handle for handle in self.worker.driver.window_handles if handle not in handles]
 
         # Take a screenshot
-        self.worker.driver.switch_to_window(self.worker.driver.window_handles[-1])
+        self.worker.driver.switch_to.window(new_handles[-1])
+        wait.until(lambda driver: driver.execute_script('return document.readyState') == 'complete')
 
         if self.worker.driver.page_source.startswith('<xsl'):
-            # Wrong window, try next one
-            self.worker.driver.switch_to_window(self.worker.driver.window_handles[-2])
+            # Alma opens both the XSL source and the output, in either order. If we got the
+            # source, wait for the output window if it hasn't opened yet, and switch to it.
+            xsl_handle = new_handles[-1]
+            wait.until(lambda driver: len(set(driver.window_handles) - handles) > 1)
+            output_handle = [handle for handle in self.worker.driver.window_handles
+                             if handle not in handles and handle != xsl_handle][-1]
+            self.worker.driver.switch_to.window(output_handle)
+            wait.until(lambda driver: driver.execute_script('return document.readyState') == 'complete')
 
         # GitHub: #30  -> if 'beanContentParam=htmlContent' in self.worker.driver.current_url:
         self.worker.driver.set_window_size(
@@ -579,98 +1200,145 @@ class TestPage(object):
         )
         with open(html_path, 'w+b') as html_file:
             html_file.write(self.worker.driver.page_source.encode('utf-8'))
-        print('Saved output: %s' % html_path)
-        if self.worker.driver.save_screenshot(png_path):
-            print('Saved screenshot: %s' % png_path)
-        else:
-            print('Failed to save screenshot')
-
-        # if not found_win:
-        #     print(Fore.RED + 'ERROR: Failed to produce output!' + Fore.RESET)
-        self.worker.driver.switch_to_window(cwh)
+        if not self.worker.driver.save_screenshot(png_path):
+            png_path = None
+
+        # Close all the windows opened by the test, so they don't pile up over many tests
+        for handle in set(self.worker.driver.window_handles) - handles:
+            self.worker.driver.switch_to.window(handle)
+            self.worker.driver.close()
+        self.worker.driver.switch_to.window(cwh)
         tmp.close()
 
+        return html_path, png_path
 
-def pull(table, local_storage, status_file):
+
+@timed('command.pull')
+def pull(table, local_storage, status_file, pool=None, fetcher=None, resume=False, remote_index=None,
+         check_all=False):
     """
     Update the local files with changes made in Alma.
 
     This will download letters whose remote checksum does not match the value in status.json.
+    Letters are only opened if their update date or user in the table has changed, or if they
+    have been updated today and not checked for a while (see RemoteIndex).
 
     Params:
         table: TemplateConfigurationTable object
         local_storage: LocalStorage object
         status_file: StatusFile object
+        pool: WorkerPool object or None
+        fetcher: HttpFetcher object or None
+        resume: Whether to skip the letters completed by the last, interrupted run
+        remote_index: RemoteIndex object or None
+        check_all: Whether to open all the letters, even those that seem unchanged
+
+    Returns a dict with lists of new and changed letters, and letters skipped due to conflicts.
     """
     today = datetime.now().strftime('%d/%m/%Y')
-    count_new = 0
-    count_changed = 0
-    for idx, filename in enumerate(table.filenames):
-        progress = '%3d/%3d' % ((idx + 1), len(table.filenames))
-
-        table.print_letter_status(filename, '', progress)
+    result = {'new': [], 'changed': [], 'conflicts': []}
+    count_checked = 0
+    journal = ProgressJournal('pull', resume)
 
+    def is_unchanged(filename):
+        if check_all:
+            return False
         if table.modified(filename) == status_file.modified(filename) and status_file.modified(filename) != today:
             # Update date has not changed, so no need to check the actual
             # contents of the letter.
+            return True
+        # Update date and user have not changed since we last opened the letter, and if
+        # it was updated today, we did that recently.
+        return remote_index is not None and remote_index.is_unchanged(
+            table, filename, status_file.checksum(filename), today)
+
+    candidates = []
+    for filename in table.filenames:
+        if is_unchanged(filename):
+            count_checked += 1
+            progress = '%3d/%3d' % (count_checked, len(table.filenames))
             table.print_letter_status(filename, 'no changes', progress, True)
             continue
 
-        # Update date has changed, or is today (and we don't have time granularity),
-        # so we should check if there are changes.
-
-        table.print_letter_status(filename, 'checking...', progress)
-        try:
-            if table.is_customized(filename):
-                content = table.open_letter(filename)
-            else:
-                content = table.open_default_letter(filename)
-        except TimeoutException:
-            # Retry once
-            table.print_letter_status(filename, 'retrying...', progress)
-            if table.is_customized(filename):
-                content = table.open_letter(filename)
-            else:
-                content = table.open_default_letter(filename)
-
-        table.close_letter()
-
-        old_sha1 = status_file.checksum(filename)
-        if content.sha1 == old_sha1:
-            table.print_letter_status(filename, 'no changes', progress, True)
+        if journal.is_completed(filename, status_file.checksum(filename)):
+            count_checked += 1
+            progress = '%3d/%3d' % (count_checked, len(table.filenames))
+            table.print_letter_status(filename, 'checked in previous run', progress, True)
             continue
 
-        # Store letter and update status.json
-        if not local_storage.store(filename, content, table.modified(filename)):
-            table.print_letter_status(
-                filename, Fore.RED + 'skipped due to conflict' + Style.RESET_ALL, progress, True)
-            continue
+        # Update date has changed, or is today (and we don't have time granularity),
+        # so we should check if there are changes.
+        candidates.append(filename)
+
+    try:
+        for filename, content in read_letters(table, candidates, pool, fetcher):
+            count_checked += 1
+            progress = '%3d/%3d' % (count_checked, len(table.filenames))
+            if remote_index is not None:
+                remote_index.set(table, filename, content.sha1)
+
+            old_sha1 = status_file.checksum(filename)
+            if content.sha1 == old_sha1:
+                journal.add(filename, content.sha1)
+                table.print_letter_status(filename, 'no changes', progress, True)
+                continue
 
-        if old_sha1 is None:
-            count_new += 1
-            table.print_letter_status(filename, Fore.GREEN + 'fetched new letter @ {}'.format(
-                content.sha1[0:7]) + Style.RESET_ALL, progress, True)
-        else:
-            count_changed += 1
-            table.print_letter_status(filename, Fore.GREEN + 'updated from {} to {}'.format(
-                old_sha1[0:7], content.sha1[0:7]) + Style.RESET_ALL, progress, True)
+            # Store letter and update status.json
+            if not local_storage.store(filename, content, table.modified(filename)):
+                result['conflicts'].append(filename)
+                table.print_letter_status(
+                    filename, Fore.RED + 'skipped due to conflict' + Style.RESET_ALL, progress, True)
+                continue
+            journal.add(filename, content.sha1)
 
+            if old_sha1 is None:
+                result['new'].append(filename)
+                table.print_letter_status(filename, Fore.GREEN + 'fetched new letter @ {}'.format(
+                    content.sha1[0:7]) + Style.RESET_ALL, progress, True)
+            else:
+                result['changed'].append(filename)
+                table.print_letter_status(filename, Fore.GREEN + 'updated from {} to {}'.format(
+                    old_sha1[0:7], content.sha1[0:7]) + Style.RESET_ALL, progress, True)
+    except BaseException:
+        journal.close()
+        print('\nRun "pull --resume" to continue where this run stopped.')
+        raise
+    finally:
+        if remote_index is not None:
+            remote_index.save()
+
+    journal.finish()
     sys.stdout.write(Fore.GREEN + 'Fetched {} new, {} changed letters\n'.format(
-        count_new, count_changed) + Style.RESET_ALL)
+        len(result['new']), len(result['changed'])) + Style.RESET_ALL)
+
+    return result
 
 
-def push(table, local_storage, status_file, files=None):
+@timed('command.push')
+def push(table, local_storage, status_file, files=None, assume_yes=False, on_conflict='ask', pool=None,
+         fetcher=None, remote_index=None):
     """
     Push local changes to Alma.
 
-    This will upload files that have been modified locally to Alma.
+    This will upload files that have been modified locally to Alma. Before uploading
+    anything, the remote versions of all the letters are checked, and letters changed
+    in Alma since the last pull are reported together, so that all conflicts can be
+    resolved at once. The remaining letters are then uploaded one after another.
 
     Params:
         table: TemplateConfigurationTable object
         local_storage: LocalStorage object
         status_file: StatusFile object
         files: list of filenames. If None, all files that have changed will be pushed.
+        assume_yes: Push the modified files without asking for confirmation
+        on_conflict: How to handle letters changed in Alma since the last pull, see resolve_conflicts()
+        pool: WorkerPool object or None, used to check the remote versions
+        fetcher: HttpFetcher object or None, used to check the remote versions
+        remote_index: RemoteIndex object or None, updated with the pushed letters
+
+    Returns a dict with lists of pushed letters, letters skipped due to conflicts and letters not found.
     """
+    result = {'pushed': [], 'conflicts': [], 'not_found': []}
     files = files or []
     if len(files) == 0:
         # If no files were specified, we will look for files that have changes.
@@ -681,7 +1349,7 @@ def push(table, local_storage, status_file, files=None):
         if len(files) == 0:
             sys.stdout.write(
                 Fore.GREEN + 'Found no modified files.' + Style.RESET_ALL + '\n')
-            return
+            return result
 
         sys.stdout.write(
             Fore.GREEN + 'Found {} modified file(s):'.format(len(files)) + Style.RESET_ALL + '\n')
@@ -689,66 +1357,342 @@ def push(table, local_storage, status_file, files=None):
             print(' - {}'.format(filename.replace('xsl/letters/', '')))
 
         msg = 'Push the file(s) to Alma? '
-        if input("%s (y/N) " % msg).lower() != 'y':
+        if not assume_yes and input("%s (y/N) " % msg).lower() != 'y':
             print('Aborting')
-            return
-
-    count_pushed = 0
-    for idx, filename in enumerate(files):
-        progress = '%d/%d' % ((idx + 1), len(files))
-        if filename not in table.filenames:
-            table.print_letter_status(filename, Fore.RED + 'File not found' + Style.RESET_ALL, progress, True)
+            return result
+
+    local_contents = OrderedDict()
+    local_stats = {}
+    for filename in files:
+        if filename not in table:
+            result['not_found'].append(filename)
+            table.print_letter_status(filename, Fore.RED + 'File not found' + Style.RESET_ALL, None, True)
             continue
-
+        # Take the stat before reading, so that edits made while pushing are not recorded as pushed
+        try:
+            local_stats[filename] = os.stat(filename)
+        except OSError:
+            local_stats[filename] = None
+        local_contents[filename] = local_storage.get_content(filename)
+        local_contents[filename].validate()
+
+    # Check the remote versions of all the letters before uploading anything
+    conflicts = OrderedDict()
+    for n, (filename, remote_content) in enumerate(read_letters(table, list(local_contents), pool, fetcher)):
+        progress = '%d/%d' % (n + 1, len(local_contents))
+        if remote_content.sha1 != status_file.checksum(filename):
+            conflicts[filename] = remote_content
+            table.print_letter_status(filename, Fore.RED + 'changed in Alma' + Style.RESET_ALL, progress, True)
+        else:
+            table.print_letter_status(filename, 'checked', progress)
+
+    if len(conflicts) != 0:
+        pairs = [(filename, local_contents[filename], remote_content) for filename, remote_content in conflicts.items()]
+        approved = resolve_conflicts(pairs, 'The remote version has changed since the last pull.', on_conflict)
+        for filename in conflicts:
+            if filename not in approved:
+                result['conflicts'].append(filename)
+                del local_contents[filename]
+
+    for idx, (filename, local_content) in enumerate(local_contents.items()):
+        progress = '%d/%d' % ((idx + 1), len(local_contents))
         table.print_letter_status(filename, 'pushing', progress)
         old_sha1 = status_file.checksum(filename)
 
-        local_content = local_storage.get_content(filename)
-        remote_content = table.open_letter(filename)
-
-        # Read text area content
-        if remote_content.sha1 != old_sha1:
-            msg = 'The remote version has changed. Overwrite remote version?'
-            if not resolve_conflict(filename, local_content, remote_content, msg):
-                table.print_letter_status(filename, 'skipped', progress, True)
-
-                # Go back
-                table.close_letter()
-
-                # Skip to next letter
-                continue
+        remote_content = retry_letter(table, filename, lambda: table.open_letter(filename))
+        expected_sha1 = conflicts[filename].sha1 if filename in conflicts else old_sha1
+        if remote_content.sha1 != expected_sha1:
+            # Changed again since we checked it
+            result['conflicts'].append(filename)
+            table.print_letter_status(
+                filename, Fore.RED + 'skipped, changed in Alma while pushing' + Style.RESET_ALL, progress, True)
+            table.close_letter()
+            continue
 
         table.put_contents(filename, local_content)
-        count_pushed += 1
+        result['pushed'].append(filename)
         msg = 'updated from {} to {}'.format(
-            old_sha1[0:7], local_content.sha1[0:7])
+            (old_sha1 or 'nothing')[0:7], local_content.sha1[0:7])
         table.print_letter_status(filename, msg, progress, True)
 
         # Update the status file
         status_file.set_checksum(filename, local_content.sha1)
         status_file.set_modified(filename)
+        stat = local_stats[filename]
+        if stat is not None:
+            status_file.set_file_stat(filename, stat, local_content.sha1)
+        if remote_index is not None:
+            remote_index.set(table, filename, local_content.sha1)
+
+    if remote_index is not None:
+        remote_index.save()
 
     sys.stdout.write(
-        Fore.GREEN + 'Pushed {} file(s)\n'.format(count_pushed) + Style.RESET_ALL)
+        Fore.GREEN + 'Pushed {} file(s)\n'.format(len(result['pushed'])) + Style.RESET_ALL)
 
+    return result
 
-def test(testpage, files, languages):
+
+class RenderCache(object):
+    """
+    Remembers what each test output was rendered from, so that unchanged tests can be skipped.
+
+    A test is unchanged if the test XML, the language and the checksums of the letters in
+    Alma, as recorded in status.json, are the same as when its output was saved. Given a
+    DependencyGraph, only the letter used by the test and the files it includes are taken
+    into account, otherwise all the letters are. The keys are stored in a
+    .slipsomat_render.json file next to the outputs.
+    """
+
+    filename = '.slipsomat_render.json'
+
+    def __init__(self, status_file, deps=None):
+        """
+        Construct a new RenderCache object.
+
+        Params:
+            status_file: StatusFile object with the checksums of the letters in Alma
+            deps: Updated DependencyGraph object or None
+        """
+        self.status_file = status_file
+        self.deps = deps
+        self.folders = {}
+        self.unsaved = set()
+
+    def letters_checksum(self, filenames=None):
+        """Return a checksum of the checksums of the pushed letters, or of all of them if filenames is None."""
+        m = hashlib.sha1()
+        for filename, letter in sorted(self.status_file.letters.items()):
+            if letter.get('checksum') is not None and (filenames is None or filename in filenames):
+                m.update('{} {}\n'.format(filename, letter['checksum']).encode('utf-8'))
+        return m.hexdigest()
+
+    def key(self, filename, lang):
+        filenames = None
+        if self.deps is not None:
+            letter = self.deps.letter_for_test(filename)
+            if letter is not None:
+                filenames = self.deps.dependencies(letter) | set([letter])
+
+        m = hashlib.sha1()
+        with open(filename, 'rb') as fp:
+            m.update(fp.read())
+        m.update('\n{}\n{}'.format(lang, self.letters_checksum(filenames)).encode('utf-8'))
+        return m.hexdigest()
+
+    def entries(self, folder):
+        if folder not in self.folders:
+            entries = {}
+            try:
+                with open(os.path.join(folder, self.filename)) as fp:
+                    entries = json.load(fp)
+            except (IOError, OSError, ValueError):
+                pass
+            self.folders[folder] = entries
+        return self.folders[folder]
+
+    def is_fresh(self, filename, lang, key):
+        """Return True if the outputs of the test exist and were rendered from the same inputs."""
+        file_root = os.path.splitext(filename)[0]
+        if not os.path.isfile('%s_%s.html' % (file_root, lang)) or not os.path.isfile('%s_%s.png' % (file_root, lang)):
+            return False
+        folder, name = os.path.split(filename)
+        return self.entries(folder).get('{}@{}'.format(name, lang)) == key
+
+    def add(self, filename, lang, key):
+        folder, name = os.path.split(filename)
+        self.entries(folder)['{}@{}'.format(name, lang)] = key
+        self.unsaved.add(folder)
+
+    def save(self):
+        for folder in self.unsaved:
+            data = json.dumps(self.folders[folder], sort_keys=True, indent=2)
+            atomic_write(os.path.join(folder, self.filename), data.encode('utf-8'))
+        self.unsaved = set()
+
+
+def testpage_for(worker, testpage):
+    """Return a TestPage for a worker, like table_for() does for tables."""
+    if worker is testpage.worker:
+        return testpage
+    if worker._test_page is None:
+        worker._test_page = TestPage(worker)
+    return worker._test_page
+
+
+@timed('command.test')
+def test(testpage, files, languages, pool=None, render_cache=None, force=False, renderer=None):
     """
     Test the output of an XML file by running a "notification template" test in Alma.
 
+    Each combination of file and language is a separate test. If a WorkerPool is given,
+    the tests are spread across its browsers, and the results are reported as they complete.
+
     Params:
-        worker: worker object
+        testpage: TestPage object
         files: list of XML files in test-data to use
         languages: list og languages to test
+        pool: WorkerPool object or None
+        render_cache: RenderCache object or None. If given, tests with unchanged inputs are skipped.
+        force: Run all the tests, also the unchanged ones
+        renderer: LocalRenderer object or None. If given, the letters are rendered locally instead
+            of in Alma, and no screenshots are taken.
+
+    Returns a dict with the outputs saved, the outputs that were up to date, and the
+    [filename, language, error] lists of tests that failed.
+    """
+    tests = []
+    keys = {}
+    result = {'outputs': [], 'unchanged': [], 'failed': []}
+    timings = {}
+    for filename in files:
+        for lang in languages:
+            if render_cache is not None and os.path.isfile(filename):
+                keys[filename, lang] = render_cache.key(filename, lang)
+                if not force and render_cache.is_fresh(filename, lang, keys[filename, lang]):
+                    result['unchanged'].append('%s_%s.html' % (os.path.splitext(filename)[0], lang))
+                    continue
+            tests.append((filename, lang))
+
+    if len(result['unchanged']) != 0:
+        print('Skipping {} test(s) with unchanged letters and test data. Use --force to run them anyway.'.format(
+            len(result['unchanged'])))
+    if len(tests) == 0:
+        return result
+
+    def run_test(page, item):
+        filename, lang = item
+        t0 = time.time()
+        try:
+            if renderer is not None:
+                paths = renderer.render(filename, lang), None
+            else:
+                paths = page.worker.retry(lambda: page.test(filename, lang))
+        except Exception as e:
+            return None, str(e).strip() or e.__class__.__name__, time.time() - t0
+        return paths, None, time.time() - t0
+
+    if pool is None or renderer is not None:
+        results = ((item, run_test(testpage, item)) for item in tests)
+    else:
+        results = pool.imap_unordered(lambda worker, item: run_test(testpage_for(worker, testpage), item), tests)
+
+    try:
+        for n, ((filename, lang), (paths, error, duration)) in enumerate(results):
+            timings[filename, lang] = (duration, error)
+            progress = '[%d/%d]' % (n + 1, len(tests))
+            if error is not None:
+                result['failed'].append([filename, lang, error])
+                print('%s %s%s@%s: %s%s' % (progress, Fore.RED, os.path.basename(filename), lang, error,
+                                            Style.RESET_ALL))
+                continue
+
+            html_path, png_path = paths
+            result['outputs'].append(html_path)
+            print('%s Saved output: %s' % (progress, html_path))
+            if png_path is not None:
+                print('%s Saved screenshot: %s' % (progress, png_path))
+                if render_cache is not None:
+                    render_cache.add(filename, lang, keys[filename, lang])
+            elif renderer is None:
+                print('%s Failed to save screenshot' % progress)
+    finally:
+        if render_cache is not None:
+            render_cache.save()
+
+    # Summary
+    print()
+    print('{:50} {:6} {:>8}  {}'.format('file', 'lang', 'seconds', 'result'))
+    for filename, lang in tests:
+        duration, error = timings[filename, lang]
+        status = Fore.GREEN + 'ok' if error is None else Fore.RED + error
+        print('{:50} {:6} {:8.3f}  {}'.format(os.path.basename(filename), lang, duration, status + Style.RESET_ALL))
+    color = Fore.RED if len(result['failed']) != 0 else Fore.GREEN
+    sys.stdout.write(color + 'Ran {} test(s): {} failed\n'.format(len(tests), len(result['failed'])) + Style.RESET_ALL)
+
+    return result
+
+
+def check_file(filename):
+    """
+    Hash and validate a local letter. Returns a (filename, sha1, error) tuple.
+
+    If the file can't be read as UTF-8, sha1 is None.
+    """
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    try:
+        content = LetterContent(data.decode('utf-8'), filename=filename)
+    except UnicodeDecodeError as e:
+        return filename, None, 'not UTF-8: {}'.format(e)
+    return filename, content.sha1, content.parse_error()
+
+
+def find_letter_files(folder):
+    """Return the paths of all .xsl files below a folder, using forward slashes like status.json."""
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for name in files:
+            if name.endswith('.xsl') and not name.startswith('.'):
+                paths.append(os.path.join(root, name).replace(os.sep, '/'))
+    return sorted(paths)
+
+
+@timed('command.check')
+def check(status_file, processes=None, deps=None):
     """
-    testpage.open()
+    Check all local letters, without the browser.
 
-    for n, filename in enumerate(files):
-        for m, lang in enumerate(languages):
-            cur = n * len(languages) + m + 1
-            tot = len(languages) * len(files)
-            print('[%d/%d] Testing "%s" using language "%s"' % (cur, tot,
-                                                                os.path.basename(filename),
-                                                                lang))
+    Hashes and validates every file in xsl/letters and defaults using a pool of
+    processes, and reports invalid XML and files that differ from status.json.
 
-            testpage.test(filename, lang)
+    Params:
+        status_file: StatusFile object
+        processes: number of processes. Defaults to the number of CPUs.
+        deps: DependencyGraph object or None. If given, the letters and test-data files
+            affected by the modified letters are reported too.
+
+    Returns a dict with lists of invalid, modified, new and unmodified files, and of
+    affected letters and tests if deps is given.
+    """
+    files = find_letter_files('xsl/letters') + find_letter_files('defaults')
+    result = {'invalid': {}, 'modified': [], 'new': [], 'unmodified': []}
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for filename, sha1, error in executor.map(check_file, files, chunksize=8):
+            if error is not None:
+                result['invalid'][filename] = error
+                print('%s%s: invalid XML: %s%s' % (Fore.RED, filename, error, Style.RESET_ALL))
+            if sha1 is None:
+                continue
+
+            if filename.startswith('defaults/'):
+                old_sha1 = status_file.default_checksum(filename[len('defaults/'):])
+            else:
+                old_sha1 = status_file.checksum(filename)
+
+            if old_sha1 is None:
+                result['new'].append(filename)
+                print('%s%s: not in status.json%s' % (Fore.YELLOW, filename, Style.RESET_ALL))
+            elif old_sha1 != sha1:
+                result['modified'].append(filename)
+                print('%s%s: modified%s' % (Fore.GREEN, filename, Style.RESET_ALL))
+            else:
+                result['unmodified'].append(filename)
+
+    changed = [filename for filename in result['modified'] + result['new'] if filename.startswith('xsl/letters/')]
+    if deps is not None and len(changed) != 0:
+        result['affected_letters'], result['affected_tests'] = deps.update().affected(changed)
+        for filename in result['affected_letters']:
+            if filename not in changed:
+                print('%s: affected by changes to included files' % filename)
+        print('Changes affect {} letter(s) and {} test file(s)'.format(
+            len(result['affected_letters']), len(result['affected_tests'])))
+
+    color = Fore.RED if len(result['invalid']) != 0 else Fore.GREEN
+    sys.stdout.write(color + 'Checked {} files: {} invalid, {} modified, {} new, {} unmodified\n'.format(
+        len(files), len(result['invalid']), len(result['modified']), len(result['new']),
+        len(result['unmodified'])) + Style.RESET_ALL)
+
+    return result
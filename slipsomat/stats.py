@@ -0,0 +1,140 @@
+# encoding=utf8
+from __future__ import print_function
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a sorted list of values, using the nearest-rank method."""
+    rank = max(1, int(round(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+class Stats(object):
+    """
+    Lightweight timing spans and WebDriver round trip counters.
+
+    Each span records its name, start time, duration, the number of WebDriver round
+    trips made by the same thread while it was open, and the name of the enclosing span.
+    """
+
+    # Upper limits of the histogram buckets, in seconds
+    buckets = [0.01, 0.1, 1, 10]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+
+    def reset(self):
+        with self.lock:
+            self.spans = []
+
+    def thread_state(self):
+        if not hasattr(self.local, 'round_trips'):
+            self.local.round_trips = 0
+            self.local.stack = []
+        return self.local
+
+    def count_round_trips(self, driver):
+        """Count every command the WebDriver sends to the browser."""
+        execute = driver.execute
+
+        @functools.wraps(execute)
+        def counted(*args, **kwargs):
+            self.thread_state().round_trips += 1
+            return execute(*args, **kwargs)
+
+        driver.execute = counted
+
+    @contextmanager
+    def span(self, name):
+        state = self.thread_state()
+        parent = state.stack[-1] if len(state.stack) != 0 else None
+        state.stack.append(name)
+        round_trips = state.round_trips
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            state.stack.pop()
+            with self.lock:
+                self.spans.append({
+                    'name': name,
+                    'parent': parent,
+                    'thread': threading.current_thread().name,
+                    'start': start,
+                    'duration': duration,
+                    'round_trips': state.round_trips - round_trips,
+                })
+
+    def timed(self, name):
+        """Decorate a function to record each call as a span."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """Return a dict of statistics per operation name."""
+        with self.lock:
+            spans = list(self.spans)
+
+        durations = {}
+        round_trips = {}
+        for span in spans:
+            durations.setdefault(span['name'], []).append(span['duration'])
+            round_trips[span['name']] = round_trips.get(span['name'], 0) + span['round_trips']
+
+        summary = {}
+        for name, values in durations.items():
+            values.sort()
+            histogram = [0] * (len(self.buckets) + 1)
+            for value in values:
+                histogram[len([limit for limit in self.buckets if value >= limit])] += 1
+            summary[name] = {
+                'count': len(values),
+                'total': sum(values),
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': values[-1],
+                'round_trips': round_trips[name],
+                'histogram': histogram,
+            }
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        if len(summary) == 0:
+            print('No timings recorded yet.')
+            return
+
+        print('{:36} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8} {:>7}  {:>6} {:>6} {:>6} {:>6} {:>6}'.format(
+            'operation', 'calls', 'total s', 'mean ms', 'p50 ms', 'p95 ms', 'max ms', 'trips',
+            '<10ms', '<100ms', '<1s', '<10s', '>=10s'))
+        for name in sorted(summary, key=lambda name: -summary[name]['total']):
+            op = summary[name]
+            print('{:36} {:6d} {:9.2f} {:8.0f} {:8.0f} {:8.0f} {:8.0f} {:7d}  {:6d} {:6d} {:6d} {:6d} {:6d}'.format(
+                name, op['count'], op['total'], 1000 * op['mean'], 1000 * op['p50'], 1000 * op['p95'],
+                1000 * op['max'], op['round_trips'], *op['histogram']))
+
+    def export(self, filename):
+        """Write all recorded spans to a JSON lines file."""
+        with self.lock:
+            spans = list(self.spans)
+        with open(filename, 'w') as fp:
+            for span in spans:
+                fp.write(json.dumps(span, sort_keys=True) + '\n')
+        return len(spans)
+
+
+stats = Stats()
+timed = stats.timed
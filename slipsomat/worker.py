@@ -3,40 +3,171 @@ from __future__ import print_function
 from textwrap import dedent
 from io import StringIO
 import getpass
+import json
+import os
+import random
 import sys
+import threading
+import time
 from selenium.webdriver.support.ui import Select
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.remote.errorhandler import NoSuchElementException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
 
+from .stats import stats, timed
+
 
 try:
     from configparser import ConfigParser  # Python 3
 except Exception:
     from ConfigParser import ConfigParser  # Python 2
 
+try:
+    from queue import Queue  # Python 3
+except ImportError:
+    from Queue import Queue  # Python 2
+
+
+class RetryPolicy(object):
+    """
+    How often and how patiently to retry failing operations, with a circuit breaker.
+
+    Failed attempts are retried after an exponentially growing delay with random jitter.
+    The policy is shared by all workers in a pool, and when too many operations fail in
+    a row, the circuit breaker opens and every worker pauses before its next attempt,
+    so that a struggling Alma gets a chance to recover instead of being hammered.
+    """
+
+    def __init__(self, attempts=3, backoff=2.0, max_backoff=60.0, breaker_failures=5, breaker_pause=60.0):
+        """
+        Construct a new RetryPolicy object.
+
+        Params:
+            attempts: Maximum number of attempts per operation
+            backoff: Delay before the first retry, in seconds. Doubled for each retry.
+            max_backoff: Upper limit of the delay between retries, in seconds
+            breaker_failures: Number of failures in a row that opens the circuit breaker
+            breaker_pause: How long to pause when the circuit breaker opens, in seconds
+        """
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_failures = max(1, breaker_failures)
+        self.breaker_pause = breaker_pause
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(attempts=int(config.get('retry', 'attempts')),
+                   backoff=float(config.get('retry', 'backoff')),
+                   max_backoff=float(config.get('retry', 'max_backoff')),
+                   breaker_failures=int(config.get('retry', 'breaker_failures')),
+                   breaker_pause=float(config.get('retry', 'breaker_pause')))
+
+    def delay(self, attempt):
+        """Return the delay before the given retry (counting from 1), with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def wait_if_open(self):
+        """Sleep while the circuit breaker is open."""
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.breaker_failures or self.open_until > time.time():
+                return
+            self.open_until = time.time() + self.breaker_pause
+            # Half-open when the pause is over: one more failure opens the breaker again
+            self.failures = self.breaker_failures - 1
+        sys.stdout.write('\n{} operations failed in a row, pausing for {:.0f} seconds...\n'.format(
+            self.breaker_failures, self.breaker_pause))
+        sys.stdout.flush()
+
 
 class Worker(object):
     """This class is mostly about providing helper methods to work efficiently with Selenium."""
 
-    def __init__(self, cfg_file):
+    def __init__(self, cfg_file, config=None):
         """
         Construct a new Worker object.
 
         Params:
             cfg_file: Name of config file
+            config: Already parsed ConfigParser object. If given, cfg_file is not read.
         """
         self.driver = None
-        self.config = self.read_config(cfg_file)
+        self._template_table = None
+        self._test_page = None
+        self.reuse_session = True
+        self.config = config if config is not None else self.read_config(cfg_file)
         self.default_timeout = int(self.config.get('selenium', 'default_timeout'))
+        self.poll_frequency = float(self.config.get('selenium', 'poll_frequency'))
         self.instance = self.config.get('login', 'instance')
+        self.retry_policy = RetryPolicy.from_config(self.config)
+
+    def timeout(self, operation):
+        """Return the timeout for an operation, from the [timeouts] section of slipsomat.cfg."""
+        value = self.config.get('timeouts', operation)
+        return float(value) if value != '' else self.default_timeout
+
+    def retry(self, fn, log=None):
+        """
+        Call fn() and return its result, retrying according to the retry policy.
+
+        Timeouts are retried as they are, while other WebDriver errors usually mean that
+        the browser crashed or the session broke, so the browser is restarted first.
 
-    def waiter(self, timeout=None):
+        Params:
+            fn: function to call
+            log: function taking a status message, called before each retry
+        """
+        policy = self.retry_policy
+        attempt = 1
+        restart = False
+        while True:
+            policy.wait_if_open()
+            try:
+                if restart:
+                    self.restart()
+                result = fn()
+            except WebDriverException as e:
+                policy.failure()
+                if attempt >= policy.attempts:
+                    raise
+                restart = not isinstance(e, TimeoutException)
+                delay = policy.delay(attempt)
+                attempt += 1
+                if log is not None:
+                    log('{}, {} in {:.1f} s ({}/{})...'.format(
+                        'timed out' if not restart else 'browser error',
+                        'retrying' if not restart else 'restarting browser',
+                        delay, attempt, policy.attempts))
+                time.sleep(delay)
+                continue
+            policy.success()
+            return result
+
+    def waiter(self, timeout=None, poll_frequency=None):
         if timeout is None:
             timeout = self.default_timeout
-        return WebDriverWait(self.driver, timeout)
+        if poll_frequency is None:
+            poll_frequency = self.poll_frequency
+        return WebDriverWait(self.driver, timeout, poll_frequency)
 
     def first(self, by, by_value):
         return self.driver.find_element(by, by_value)
@@ -44,10 +175,12 @@ class Worker(object):
     def all(self, by, by_value):
         return self.driver.find_elements(by, by_value)
 
+    @timed('worker.wait_for')
     def wait_for(self, by, by_value, timeout=None):
         wait = self.wait if timeout is None else self.waiter(timeout)
         return wait.until(EC.visibility_of_element_located((by, by_value)))
 
+    @timed('worker.wait_for_and_click')
     def wait_for_and_click(self, by, by_value, timeout=None):
         elem = self.wait_for(by, by_value, timeout)
         elem.click()
@@ -57,13 +190,15 @@ class Worker(object):
         element.send_keys(text)
         return element
 
+    @timed('worker.click')
     def click(self, by, by_value):
         element = self.wait.until(EC.element_to_be_clickable((by, by_value)))
         element.click()
         return element
 
+    @timed('worker.scroll_into_view_and_click')
     def scroll_into_view_and_click(self, value, by=By.ID):
-        element = self.driver.find_element(by, value)
+        element = self.wait.until(EC.presence_of_element_located((by, value)))
         self.driver.execute_script('arguments[0].scrollIntoView();', element)
         # Need to scroll a little bit more because of the fixed header
         self.driver.execute_script('window.scroll(window.scrollX, window.scrollY-400)')
@@ -74,6 +209,8 @@ class Worker(object):
             element.send_keys(Keys.RETURN)  # works in some edge cases
 
     def close(self):
+        if self.driver is None:
+            return
         try:
             self.driver.close()
         except Exception as e:
@@ -91,10 +228,36 @@ class Worker(object):
         defaults = StringIO(dedent(
             u"""[login]
             domain=
+            base_url=
+            session_file=.slipsomat_session
 
             [selenium]
             browser=firefox
+            headless=false
             default_timeout=20
+            poll_frequency=0.1
+            workers=1
+
+            [timeouts]
+            login=30
+            restore_session=10
+            save_letter=40
+            letter_content=5
+            test=
+
+            [retry]
+            attempts=3
+            backoff=2
+            max_backoff=60
+            breaker_failures=5
+            breaker_pause=60
+
+            [pull]
+            recheck_interval=900
+
+            [http]
+            fast_path=false
+            concurrency=8
 
             [window]
             width=1300
@@ -110,50 +273,165 @@ class Worker(object):
         if config.get('login', 'username') == '':
             raise RuntimeError('No username configured in slipsomat.cfg')
 
-        if config.get('login', 'password') == '':
-            config.set('login', 'password', getpass.getpass())
-
         return config
 
+    def get_password(self):
+        """Return the password, asking for it if it's not in the config file."""
+        if self.config.get('login', 'password') == '':
+            self.config.set('login', 'password', getpass.getpass())
+        return self.config.get('login', 'password')
+
     def get_driver(self):
         # Start a new browser and return the WebDriver
 
         browser_name = self.config.get('selenium', 'browser')
+        headless = self.config.getboolean('selenium', 'headless')
 
         if browser_name == 'firefox':
-            from selenium.webdriver import Firefox
+            from selenium.webdriver import Firefox, FirefoxOptions
 
-            return Firefox()
+            options = FirefoxOptions()
+            if headless:
+                options.add_argument('-headless')
+                # Don't load images and web fonts, and skip animations
+                options.set_preference('permissions.default.image', 2)
+                options.set_preference('browser.display.use_document_fonts', 0)
+                options.set_preference('toolkit.cosmeticAnimations.enabled', False)
+                options.set_preference('ui.prefersReducedMotion', 1)
+                options.page_load_strategy = 'eager'
 
-        if browser_name == 'chrome':
-            from selenium.webdriver import Chrome
+            return Firefox(options=options)
 
-            return Chrome()
+        if browser_name == 'chrome':
+            from selenium.webdriver import Chrome, ChromeOptions
+
+            options = ChromeOptions()
+            if headless:
+                options.add_argument('--headless')
+                options.add_argument('--disable-gpu')
+                options.add_argument('--disable-extensions')
+                options.add_argument('--disable-remote-fonts')
+                options.add_argument('--force-prefers-reduced-motion')
+                options.add_experimental_option('prefs', {
+                    'profile.managed_default_content_settings.images': 2,
+                })
+                options.page_load_strategy = 'eager'
+
+            return Chrome(options=options)
 
         if browser_name == 'phantomjs':
             from selenium.webdriver import PhantomJS
 
             return PhantomJS()
 
-        # @TODO: Add chrome
         raise RuntimeError('Unsupported/unknown browser')
 
-    def connect(self):
+    def clone(self):
+        """
+        Return a new, unconnected Worker sharing the configuration of this one.
+
+        The clone logs in with its own session, since browsers sharing a session would
+        trample on each other's server-side page state in Alma.
+        """
+        worker = Worker(None, config=self.config)
+        worker.reuse_session = False
+        worker.retry_policy = self.retry_policy
+        return worker
+
+    def restore_session(self):
+        """
+        Load the cookies stored by save_session() into the browser.
+
+        Return True if this gave us a working Alma session.
+        """
+        session_file = self.config.get('login', 'session_file')
+        if session_file == '' or not os.path.isfile(session_file):
+            return False
+
+        try:
+            with open(session_file) as fp:
+                session = json.load(fp)
+        except ValueError:
+            return False
+
+        if session.get('instance') != self.instance or \
+                session.get('institution') != self.config.get('login', 'institution') or \
+                session.get('username') != self.config.get('login', 'username'):
+            return False
+
+        # Cookies can only be added for the domain of the page currently loaded
+        self.get('/favicon.ico')
+        for cookie in session.get('cookies', []):
+            if 'expiry' in cookie:
+                cookie['expiry'] = int(cookie['expiry'])
+            try:
+                self.driver.add_cookie(cookie)
+            except WebDriverException:
+                pass  # E.g. a cookie from the identity provider's domain
+
+        self.get('/mng/action/home.do')
+        try:
+            state = self.waiter(self.timeout('restore_session')).until(self.session_state)
+        except TimeoutException:
+            return False
+
+        return state == 'alma'
+
+    def session_state(self, driver):
+        """
+        Wait condition telling if we got to Alma or were sent to log in, for restore_session().
+
+        Returns "alma" at the Alma main screen, "login" at a login page or form, or False
+        if the page is still loading, so that an expired session fails right away
+        instead of waiting for the full timeout.
+        """
+        if len(driver.find_elements(By.CSS_SELECTOR, '.logoAlma')) != 0:
+            return 'alma'
+        if '/login' in driver.current_url or not driver.current_url.startswith(self.url('')) or \
+                len(driver.find_elements(By.CSS_SELECTOR, '#username, input[type=password]')) != 0:
+            return 'login'
+        return False
+
+    def save_session(self):
+        """Store the session cookies, so the next connect() can skip the login."""
+        session_file = self.config.get('login', 'session_file')
+        if session_file == '':
+            return
+
+        session = {
+            'instance': self.instance,
+            'institution': self.config.get('login', 'institution'),
+            'username': self.config.get('login', 'username'),
+            'cookies': self.driver.get_cookies(),
+        }
+
+        # The cookies give access to Alma, so keep the file private
+        fd = os.open(session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(session, fp)
+
+    @timed('worker.connect')
+    def connect(self, verbose=True):
         domain = self.config.get('login', 'domain')
         auth_type = self.config.get('login', 'auth_type')
         institution = self.config.get('login', 'institution')
         username = self.config.get('login', 'username')
-        password = self.config.get('login', 'password')
 
         self.driver = self.get_driver()
+        stats.count_round_trips(self.driver)
         self.driver.set_window_size(self.config.get('window', 'width'),
                                     self.config.get('window', 'height'))
         self.wait = self.waiter()
 
-        print('Connecting to {}:{}'.format(self.instance, institution))
+        log = sys.stdout.write if verbose else (lambda msg: None)
+        log('Connecting to {}:{}\n'.format(self.instance, institution))
+
+        if self.reuse_session and self.restore_session():
+            log('Reusing session for {}\n'.format(username))
+            return
 
         if auth_type == 'Feide' and domain != '':
-            sys.stdout.write('Logging in as {}@{}...'.format(username, domain))
+            log('Logging in as {}@{}...'.format(username, domain))
 
             self.get('/mng/login?institute={}&auth=SAML'.format(institution))
 
@@ -163,37 +441,166 @@ class Worker(object):
             element = self.wait.until(EC.visibility_of_element_located((By.XPATH, '//div[@data-value="%s"]' % domain)))
             element.click()
 
-            element = self.driver.find_element_by_id('selectorg_button')
+            element = self.driver.find_element(By.ID, 'selectorg_button')
             element.click()
 
         elif auth_type == 'SAML' and domain != '':
-            sys.stdout.write('Logging in as {}@{}...'.format(username, domain))
+            log('Logging in as {}@{}...'.format(username, domain))
             self.get('/mng/login?institute={}&auth={}'.format(institution, auth_type))
 
             element = self.wait.until(EC.visibility_of_element_located((By.ID, 'org')))
             select = Select(element)
             select.select_by_value(domain)
 
-            element = self.driver.find_element_by_id('submit')
+            element = self.driver.find_element(By.ID, 'submit')
             element.click()
             # We cannot use submit() because of
             # http://stackoverflow.com/questions/833032/submit-is-not-a-function-error-in-javascript
         else:
-            sys.stdout.write('Logging in as {}...'.format(username))
+            log('Logging in as {}...'.format(username))
             self.get('/mng/login?institute={}&auth={}'.format(institution, auth_type))
 
         element = self.wait.until(EC.visibility_of_element_located((By.ID, 'username')))
         self.send_keys(By.ID, 'username', username)
-        element = self.send_keys(By.ID, 'password', password)
+        element = self.send_keys(By.ID, 'password', self.get_password())
         element.send_keys(Keys.RETURN)
 
         try:
             # Look for some known element on the Alma main screen
-            self.wait_for(By.CSS_SELECTOR, '.logoAlma', 30)
+            self.wait_for(By.CSS_SELECTOR, '.logoAlma', self.timeout('login'))
         except NoSuchElementException:
             raise Exception('Failed to login to Alma')
 
-        sys.stdout.write(' DONE\n')
+        if self.reuse_session:
+            self.save_session()
 
+        log(' DONE\n')
+
+    def url(self, path):
+        base_url = self.config.get('login', 'base_url') or 'https://{}.alma.exlibrisgroup.com'.format(self.instance)
+        return '{}/{}'.format(base_url.rstrip('/'), path.lstrip('/'))
+
+    @timed('worker.get')
     def get(self, url):
-        return self.driver.get('https://{}.alma.exlibrisgroup.com/{}'.format(self.instance, url.lstrip('/')))
+        return self.driver.get(self.url(url))
+
+
+class WorkerPool(object):
+    """
+    A pool of logged-in workers, each with its own browser.
+
+    The first worker is the one the shell already uses, additional workers are started
+    on demand the first time there is enough work to keep them busy.
+    """
+
+    _done = object()
+
+    def __init__(self, worker, size=None):
+        """
+        Construct a new WorkerPool object.
+
+        Params:
+            worker: Connected Worker object to use as the first worker in the pool
+            size: Maximum number of workers. Defaults to the "workers" option in slipsomat.cfg
+        """
+        if size is None:
+            size = int(worker.config.get('selenium', 'workers'))
+        self.size = max(1, size)
+        self.workers = [worker]
+
+    def start(self, count):
+        """Make sure that `count` workers (but no more than the pool size) are connected."""
+        new_workers = [self.workers[0].clone() for _ in range(min(count, self.size) - len(self.workers))]
+        if len(new_workers) == 0:
+            return
+
+        # Ask for the password up front rather than from the worker threads
+        self.workers[0].get_password()
+
+        sys.stdout.write('Starting {} additional browser(s)...'.format(len(new_workers)))
+        sys.stdout.flush()
+        errors = []
+
+        def connect(worker):
+            try:
+                worker.connect(verbose=False)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=connect, args=(worker,)) for worker in new_workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(errors) != 0:
+            for worker in new_workers:
+                if worker.driver is not None:
+                    worker.close()
+            raise errors[0]
+
+        self.workers += new_workers
+        sys.stdout.write(' DONE\n')
+
+    def imap_unordered(self, fn, items):
+        """
+        Call fn(worker, item) for each item and yield (item, result) tuples.
+
+        The items are sharded across the workers, and each worker processes its shard in a
+        separate thread, also when there is only one worker. Results are yielded in the
+        calling thread in order of completion, so the caller can act as the single writer
+        for shared state like the status file, and do its work while the browsers move on
+        to the next items. If fn raises an exception, the other workers stop after their
+        current item and the exception is re-raised in the calling thread.
+        """
+        items = list(items)
+        if len(items) == 0:
+            return
+
+        self.start(len(items))
+        workers = self.workers[:len(items)]
+        results = Queue()
+        stop = threading.Event()
+
+        def run(worker, shard):
+            try:
+                for item in shard:
+                    if stop.is_set():
+                        break
+                    results.put((item, fn(worker, item), None))
+            except Exception as e:
+                results.put((None, None, e))
+            finally:
+                results.put(self._done)
+
+        threads = [
+            threading.Thread(target=run, args=(worker, items[n::len(workers)]))
+            for n, worker in enumerate(workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            running = len(threads)
+            while running > 0:
+                msg = results.get()
+                if msg is self._done:
+                    running -= 1
+                    continue
+                item, result, error = msg
+                if error is not None:
+                    raise error
+                yield item, result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def restart(self):
+        for worker in self.workers:
+            worker.restart()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()